@@ -1,6 +1,10 @@
+import asyncio
+import functools
 import aiosqlite
 import re
-from datetime import datetime, timezone, timedelta
+import time
+from datetime import datetime, timezone
+from types import MappingProxyType
 
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, Message
@@ -8,43 +12,136 @@ from aiogram.enums import ParseMode
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 
+import database
+import utils
+
 router = Router()
 
-_DB_PATH: str | None = None
-_ADMIN_IDS: set[int] = set()
+_ADMIN_IDS: frozenset[int] = frozenset()
 
 PAGE_SIZE = 10
 BONUS_DAYS_FOR_REFERRER = 14
 
-TARIFFS = {
+TARIFFS = MappingProxyType({
     "outline": {"title": "OutLine", "price": 70},
     "v2ray": {"title": "v2raytun", "price": 70},
     "bundle": {"title": "OutLine/V2RayTun + AmneziaVPN", "price": 140},
+})
+
+# шаблоны сообщений админки: один format_map на рендер вместо цепочки f-строк
+_USER_CARD_TMPL = (
+    "👤 <b>Управление пользователем</b>\n\n"
+    "• Имя: <b>{full_name}</b>\n"
+    "• Username: <b>{uname}</b>\n"
+    "• ID: <code>{uid}</code>\n"
+    "• Регистрация: <b>{created}</b>\n"
+    "• Первая оплата: <b>{first_paid}</b>\n\n"
+    "🔐 <b>Подписка</b>\n"
+    "• Тариф: <b>{tariff}</b>\n"
+    "• Оформление: <b>{purchased}</b>\n"
+    "• Период (дней): <b>{period}</b>\n"
+    "• Действует до: <b>{expires}</b>\n\n"
+    "🔑 <b>Ключи</b>\n"
+    "• OutLine: <b>{outline}</b>\n"
+    "• v2raytun: <b>{v2ray}</b>\n"
+    "• AmneziaVPN: <b>{amnezia}</b>\n"
+)
+_USERS_HEADER_TMPL = "👥 <b>Пользователи</b> (показано {shown} из {total})\n"
+_USERS_ROW_TMPL = "• <b>{full_name}</b> ({uname}) — до: <b>{expires}</b>{keys_mark}"
+_KEY_MARK = ("—", "✅ выдан")
+
+# тип ключа -> колонка user_keys / название для сообщений
+_KEY_COL = {
+    "outline": "outline_key",
+    "v2ray": "v2ray_key",
+    "amnezia": "amnezia_key",
+}
+_KEY_TITLES = {
+    "outline": "OutLine",
+    "v2ray": "v2raytun",
+    "amnezia": "AmneziaVPN",
+}
+_KEY_TYPES = frozenset(_KEY_COL)
+
+# формат ключа по типу: отсекаем случайный мусор до записи в БД
+_KEY_RE = {
+    "outline": re.compile(r"ss(conf)?://[A-Za-z0-9+/=@:._\-]+"),
+    "v2ray": re.compile(r"(vless|vmess|trojan)://\S+"),
+    "amnezia": re.compile(r"(vpn://\S+|\{)"),
+}
+_KEY_HINTS = {
+    "outline": "ss://… или ssconf://…",
+    "v2ray": "vless://…, vmess://… или trojan://…",
+    "amnezia": "vpn://… или JSON-конфиг",
+}
+
+# разбор callback_data: fullmatch сразу проверяет формат и допустимые значения
+_ADMIN_USERS_RE = re.compile(r"admin_users:(\d+)")
+_ADMIN_USER_RE = re.compile(r"admin_user:(\d+)")
+_ADMIN_TARIFF_RE = re.compile(r"admin_tariff:(\d+)")
+_ADMIN_SET_TARIFF_RE = re.compile(r"admin_set_tariff:(\d+):(" + "|".join(map(re.escape, TARIFFS)) + ")")
+_ADMIN_PERIOD_RE = re.compile(r"admin_period:(\d+)")
+_ADMIN_ADD_RE = re.compile(r"admin_add:(\d+):(1|2|3|6|12)")
+_ADMIN_KEY_RE = re.compile(r"admin_key:(\d+):(" + "|".join(map(re.escape, _KEY_COL)) + ")")
+
+# готовый UPSERT на каждую колонку: SQL собирается один раз при импорте, а не на каждый вызов
+_SET_KEY_SQL = {
+    key_type: f"""
+        INSERT INTO user_keys(user_id, {col}, updated_at, updated_by)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            {col} = excluded.{col},
+            updated_at = excluded.updated_at,
+            updated_by = excluded.updated_by
+    """
+    for key_type, col in _KEY_COL.items()
 }
 
+# короткий кэш счётчиков панели: повторные открытия подряд не ходят в БД
+_STATS_TTL = 10.0
+_stats_cache: tuple[float, tuple[int, int]] | None = None
+# растёт при каждой записи: загрузка, начатая до записи, не кладёт устаревший результат в кэш
+_stats_gen = 0
 
-def setup_admin(db_path: str, admin_ids: set[int]) -> None:
-    global _DB_PATH, _ADMIN_IDS
-    _DB_PATH = db_path
-    _ADMIN_IDS = admin_ids
+# одинаковые запросы, пришедшие одновременно (двойной клик), делят один поход в БД
+_inflight: dict[str, asyncio.Future] = {}
+# результат общего запроса, если первый вызов отменили: ожидающие повторяют запрос сами
+_RETRY = object()
+
+
+def setup_admin(admin_ids: set[int] | frozenset[int]) -> None:
+    global _ADMIN_IDS
+    _ADMIN_IDS = frozenset(admin_ids)
 
 
 def is_admin(user_id: int) -> bool:
     return user_id in _ADMIN_IDS
 
 
+_ADMIN_PANEL_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Список пользователей", callback_data="admin_users:0")],
+])
+
+_CANCEL_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_key_cancel")]
+])
+
+
 def admin_panel_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Список пользователей", callback_data="admin_users:0")],
-    ])
+    return _ADMIN_PANEL_KB
 
 
 def users_list_kb(offset: int, total: int) -> InlineKeyboardMarkup:
+    return _users_list_kb(offset, offset + PAGE_SIZE < total)
+
+
+@functools.lru_cache(maxsize=256)
+def _users_list_kb(offset: int, has_next: bool) -> InlineKeyboardMarkup:
     buttons = []
     row = []
     if offset > 0:
         row.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"admin_users:{max(0, offset - PAGE_SIZE)}"))
-    if offset + PAGE_SIZE < total:
+    if has_next:
         row.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"admin_users:{offset + PAGE_SIZE}"))
     if row:
         buttons.append(row)
@@ -53,6 +150,7 @@ def users_list_kb(offset: int, total: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+@functools.lru_cache(maxsize=1024)
 def user_manage_kb(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -82,6 +180,7 @@ def user_manage_kb(user_id: int) -> InlineKeyboardMarkup:
     ])
 
 
+@functools.lru_cache(maxsize=1024)
 def tariff_select_kb(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="OutLine — 70 ₽/мес", callback_data=f"admin_set_tariff:{user_id}:outline")],
@@ -92,25 +191,7 @@ def tariff_select_kb(user_id: int) -> InlineKeyboardMarkup:
 
 
 def cancel_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_key_cancel")]
-    ])
-
-
-def _parse_iso(dt_iso: str | None):
-    if not dt_iso:
-        return None
-    try:
-        return datetime.fromisoformat(dt_iso)
-    except Exception:
-        return None
-
-
-def _fmt(dt_iso: str | None) -> str:
-    dt = _parse_iso(dt_iso)
-    if not dt:
-        return "—"
-    return dt.strftime("%d.%m.%Y %H:%M")
+    return _CANCEL_KB
 
 
 def _tariff_title(code: str | None) -> str:
@@ -127,44 +208,96 @@ class AdminPeriodStates(StatesGroup):
     waiting_period = State()
 
 
+def _invalidate_stats() -> None:
+    """Вызывать после commit: до него читатели ещё видят старые счётчики."""
+    global _stats_cache, _stats_gen
+    _stats_cache = None
+    _stats_gen += 1
+
+
+async def _single_flight(key: str, load):
+    """
+    Первый вызов по ключу идёт в БД, конкурентные ждут его результат.
+    Если первый вызов отменили, ожидающие не получают чужую отмену: один из них повторяет запрос.
+    """
+    while (fut := _inflight.get(key)) is not None:
+        # shield: отмена одного ожидающего не должна отменять общий запрос
+        result = await asyncio.shield(fut)
+        if result is not _RETRY:
+            return result
+
+    fut = asyncio.get_running_loop().create_future()
+    # исключение без ожидающих не должно давать "never retrieved" в логах
+    fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _inflight[key] = fut
+    try:
+        result = await load()
+    except asyncio.CancelledError:
+        fut.set_result(_RETRY)
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    else:
+        fut.set_result(result)
+        return result
+    finally:
+        del _inflight[key]
+
+
 async def _stats():
-    if _DB_PATH is None:
-        raise RuntimeError("admin not setup")
+    if _stats_cache and time.monotonic() - _stats_cache[0] < _STATS_TTL:
+        return _stats_cache[1]
 
-    now = datetime.now(timezone.utc)
+    return await _single_flight("stats", _load_stats)
 
-    async with aiosqlite.connect(_DB_PATH) as db:
-        cur = await db.execute("SELECT COUNT(*) FROM users")
-        total = int((await cur.fetchone())[0])
 
-        cur = await db.execute("SELECT expires_at FROM subscriptions")
-        rows = await cur.fetchall()
-        active = 0
-        for (expires_at,) in rows:
-            dt = _parse_iso(expires_at)
-            if dt and dt > now:
-                active += 1
+async def _load_stats():
+    global _stats_cache
+    gen = _stats_gen
+    now_ts = int(time.time())
 
-    return total, active
+    async with database.connection() as db:
+        cur = await db.execute("""
+            SELECT (SELECT COUNT(*) FROM users),
+                   (SELECT COUNT(*) FROM subscriptions WHERE expires_at > ?)
+        """, (now_ts,))
+        total, active = await cur.fetchone()
+
+    result = int(total), int(active)
+    # пока читали, могла пройти запись — такой результат не кэшируем
+    if gen == _stats_gen:
+        _stats_cache = (time.monotonic(), result)
+    return result
 
 
 async def _list_users(offset: int, limit: int):
-    if _DB_PATH is None:
-        raise RuntimeError("admin not setup")
+    return await _single_flight(f"users:{offset}:{limit}", lambda: _load_users_page(offset, limit))
 
-    async with aiosqlite.connect(_DB_PATH) as db:
-        cur = await db.execute("SELECT COUNT(*) FROM users")
-        total = int((await cur.fetchone())[0])
 
+async def _load_users_page(offset: int, limit: int):
+    async with database.connection() as db:
+        # общее число приходит оконной функцией вместе со страницей — один запрос вместо двух
         cur = await db.execute("""
-            SELECT u.telegram_id, u.first_name, u.last_name, u.username, s.expires_at
+            SELECT u.telegram_id, u.first_name, u.last_name, u.username, s.expires_at,
+                   IFNULL(k.outline_key, '') <> '', IFNULL(k.v2ray_key, '') <> '', IFNULL(k.amnezia_key, '') <> '',
+                   COUNT(*) OVER () AS total_cnt
             FROM users u
             LEFT JOIN subscriptions s ON s.telegram_id = u.telegram_id
+            LEFT JOIN user_keys k ON k.user_id = u.telegram_id
             ORDER BY u.created_at DESC
             LIMIT ? OFFSET ?
         """, (limit, offset))
-        users = await cur.fetchall()
+        rows = await cur.fetchall()
+
+        if rows:
+            total = int(rows[0][-1])
+        else:
+            # страница пустая (offset за концом списка) — число берём отдельно
+            cur = await db.execute("SELECT COUNT(*) FROM users")
+            total = int((await cur.fetchone())[0])
 
+    users = [row[:-1] for row in rows]
     return total, users
 
 
@@ -172,150 +305,82 @@ async def _get_user(user_id: int):
     """
     Возвращает:
     uid, first, last, username, created_at, first_paid, first_paid_at,
-    purchased_at, period_days, expires_at, tariff
+    purchased_at, period_days, expires_at, tariff,
+    has_outline, has_v2ray, has_amnezia
     """
-    if _DB_PATH is None:
-        raise RuntimeError("admin not setup")
-
-    async with aiosqlite.connect(_DB_PATH) as db:
+    async with database.connection() as db:
         cur = await db.execute("""
             SELECT u.telegram_id, u.first_name, u.last_name, u.username,
                    u.created_at, u.first_paid, u.first_paid_at,
-                   s.purchased_at, s.period_days, s.expires_at, s.tariff
+                   s.purchased_at, s.period_days, s.expires_at, s.tariff,
+                   IFNULL(k.outline_key, '') <> '', IFNULL(k.v2ray_key, '') <> '', IFNULL(k.amnezia_key, '') <> ''
             FROM users u
             LEFT JOIN subscriptions s ON s.telegram_id = u.telegram_id
+            LEFT JOIN user_keys k ON k.user_id = u.telegram_id
             WHERE u.telegram_id=?
         """, (user_id,))
         row = await cur.fetchone()
     return row
 
 
-async def _get_keys(user_id: int):
-    if _DB_PATH is None:
-        raise RuntimeError("admin not setup")
-
-    async with aiosqlite.connect(_DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT outline_key, v2ray_key, amnezia_key FROM user_keys WHERE user_id=?
-        """, (user_id,))
-        row = await cur.fetchone()
-    if not row:
-        return None, None, None
-    return row[0], row[1], row[2]
-
-
 def _key_title(key_type: str) -> str:
-    return {
-        "outline": "OutLine",
-        "v2ray": "v2raytun",
-        "amnezia": "AmneziaVPN",
-    }[key_type]
-
-
-async def _set_key(user_id: int, key_type: str, key_value: str, admin_id: int):
-    if _DB_PATH is None:
-        raise RuntimeError("admin not setup")
+    return _KEY_TITLES[key_type]
 
-    now = datetime.now(timezone.utc).isoformat()
 
-    col = {
-        "outline": "outline_key",
-        "v2ray": "v2ray_key",
-        "amnezia": "amnezia_key",
-    }[key_type]
+async def _set_key(db: aiosqlite.Connection, user_id: int, key_type: str, key_value: str, admin_id: int):
+    now = int(time.time())
 
-    async with aiosqlite.connect(_DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO user_keys(user_id, outline_key, v2ray_key, amnezia_key, updated_at, updated_by)
-            VALUES (?, NULL, NULL, NULL, ?, ?)
-            ON CONFLICT(user_id) DO NOTHING
-        """, (user_id, now, admin_id))
+    await db.execute(_SET_KEY_SQL[key_type], (user_id, key_value, now, admin_id))
 
-        await db.execute(f"""
-            UPDATE user_keys
-            SET {col} = ?, updated_at = ?, updated_by = ?
-            WHERE user_id = ?
-        """, (key_value, now, admin_id, user_id))
 
-        await db.commit()
+async def _set_subscription_tariff(db: aiosqlite.Connection, user_id: int, tariff_code: str):
+    # создаём строку subscriptions, если её нет, иначе только меняем тариф
+    await db.execute("""
+        INSERT INTO subscriptions(telegram_id, purchased_at, period_days, expires_at, tariff, warn_2d_sent, expired_sent, keys_deleted)
+        VALUES (?, NULL, NULL, NULL, ?, 0, 0, 0)
+        ON CONFLICT(telegram_id) DO UPDATE SET tariff=excluded.tariff
+    """, (user_id, tariff_code))
 
 
-async def _set_subscription_tariff(user_id: int, tariff_code: str):
-    if _DB_PATH is None:
-        raise RuntimeError("admin not setup")
-
-    async with aiosqlite.connect(_DB_PATH) as db:
-        # гарантируем строку subscriptions
-        await db.execute("""
-            INSERT INTO subscriptions(telegram_id, purchased_at, period_days, expires_at, tariff, warn_2d_sent, expired_sent, keys_deleted)
-            VALUES (?, NULL, NULL, NULL, ?, 0, 0, 0)
-            ON CONFLICT(telegram_id) DO NOTHING
-        """, (user_id, tariff_code))
-
-        await db.execute("UPDATE subscriptions SET tariff=? WHERE telegram_id=?", (tariff_code, user_id))
-        await db.commit()
-
-
-async def _add_days(user_id: int, days: int):
+async def _add_days(db: aiosqlite.Connection, user_id: int, days: int) -> tuple[int, int, str | None]:
     """
     Добавляет дни к expires_at:
     - если подписки нет -> создаёт
     - если активна -> продлевает от expires_at
     - если истекла -> продлевает от now
     Также сбрасывает warn/expired/keys_deleted, если подписка стала активной.
+    Возвращает новое состояние (period_days, expires_at, tariff) — без повторного SELECT.
+    """
+    now_ts = int(time.time())
+
+    # одним UPSERT: база продления = MAX(expires_at, now), purchased_at заполняем только если пустой
+    async with db.execute("""
+        INSERT INTO subscriptions(telegram_id, purchased_at, period_days, expires_at, tariff, warn_2d_sent, expired_sent, keys_deleted)
+        VALUES (:uid, :now, :days, :now + :days * :day, NULL, 0, 0, 0)
+        ON CONFLICT(telegram_id) DO UPDATE SET
+            purchased_at = COALESCE(subscriptions.purchased_at, excluded.purchased_at),
+            period_days = COALESCE(subscriptions.period_days, 0) + :days,
+            expires_at = MAX(COALESCE(subscriptions.expires_at, :now), :now) + :days * :day
+        RETURNING period_days, expires_at, tariff
+    """, {"uid": user_id, "now": now_ts, "days": days, "day": utils.SECONDS_PER_DAY}) as cur:
+        period_days, expires_at, tariff = await cur.fetchone()
+
+    # флаги сбрасываем только если они реально подняты — продление активной подписки обходится без лишней записи
+    await db.execute("""
+        UPDATE subscriptions
+        SET warn_2d_sent=0, expired_sent=0, keys_deleted=0
+        WHERE telegram_id=? AND (warn_2d_sent | expired_sent | keys_deleted) <> 0
+    """, (user_id,))
+    return int(period_days), int(expires_at), tariff
+
+
+async def _add_months(db: aiosqlite.Connection, user_id: int, months: int) -> tuple[int, int, str | None]:
+    """
+    Возвращает (добавлено дней, expires_at, tariff).
     """
-    if _DB_PATH is None:
-        raise RuntimeError("admin not setup")
-
-    now = datetime.now(timezone.utc)
-
-    async with aiosqlite.connect(_DB_PATH) as db:
-        cur = await db.execute("SELECT period_days, expires_at, tariff FROM subscriptions WHERE telegram_id=?", (user_id,))
-        row = await cur.fetchone()
-
-        if not row:
-            purchased_at = now
-            period_days = days
-            expires_at = now + timedelta(days=days)
-            await db.execute("""
-                INSERT INTO subscriptions(telegram_id, purchased_at, period_days, expires_at, tariff, warn_2d_sent, expired_sent, keys_deleted)
-                VALUES (?, ?, ?, ?, NULL, 0, 0, 0)
-            """, (user_id, purchased_at.isoformat(), period_days, expires_at.isoformat()))
-            await db.commit()
-            return
-
-        period_days, expires_at, tariff = row
-        period_days = int(period_days or 0)
-
-        exp_dt = _parse_iso(expires_at)
-        base = exp_dt if (exp_dt and exp_dt > now) else now
-
-        new_expires = base + timedelta(days=days)
-        new_period = period_days + days
-
-        await db.execute("""
-            UPDATE subscriptions
-            SET period_days=?,
-                expires_at=?,
-                warn_2d_sent=0,
-                expired_sent=0,
-                keys_deleted=0
-            WHERE telegram_id=?
-        """, (new_period, new_expires.isoformat(), user_id))
-
-        # если purchased_at пустой — заполним
-        cur = await db.execute("SELECT purchased_at FROM subscriptions WHERE telegram_id=?", (user_id,))
-        p = await cur.fetchone()
-        if p and not p[0]:
-            await db.execute("UPDATE subscriptions SET purchased_at=? WHERE telegram_id=?", (now.isoformat(), user_id))
-
-        await db.commit()
-
-
-async def _add_months(user_id: int, months: int) -> int:
     days = months * 30
-    await _add_days(user_id, days)
-    return days
+    _, expires_at, tariff = await _add_days(db, user_id, days)
+    return days, expires_at, tariff
 
 
 def _parse_period_input(raw_text: str) -> tuple[datetime, datetime] | None:
@@ -341,101 +406,86 @@ def _parse_period_input(raw_text: str) -> tuple[datetime, datetime] | None:
     return start_dt, end_dt
 
 
-async def _set_period_range(user_id: int, start_dt: datetime, end_dt: datetime) -> int:
-    if _DB_PATH is None:
-        raise RuntimeError("admin not setup")
-
+async def _set_period_range(db: aiosqlite.Connection, user_id: int, start_dt: datetime, end_dt: datetime) -> int:
     period_days = (end_dt.date() - start_dt.date()).days + 1
-
-    async with aiosqlite.connect(_DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO subscriptions(telegram_id, purchased_at, period_days, expires_at, tariff, warn_2d_sent, expired_sent, keys_deleted)
-            VALUES (?, ?, ?, ?, NULL, 0, 0, 0)
-            ON CONFLICT(telegram_id) DO NOTHING
-        """, (user_id, start_dt.isoformat(), period_days, end_dt.isoformat()))
-
-        await db.execute("""
-            UPDATE subscriptions
-            SET purchased_at=?,
-                period_days=?,
-                expires_at=?,
-                warn_2d_sent=0,
-                expired_sent=0,
-                keys_deleted=0
-            WHERE telegram_id=?
-        """, (start_dt.isoformat(), period_days, end_dt.isoformat(), user_id))
-        await db.commit()
+    start_ts = int(start_dt.timestamp())
+    end_ts = int(end_dt.timestamp())
+
+    await db.execute("""
+        INSERT INTO subscriptions(telegram_id, purchased_at, period_days, expires_at, tariff, warn_2d_sent, expired_sent, keys_deleted)
+        VALUES (?, ?, ?, ?, NULL, 0, 0, 0)
+        ON CONFLICT(telegram_id) DO NOTHING
+    """, (user_id, start_ts, period_days, end_ts))
+
+    await db.execute("""
+        UPDATE subscriptions
+        SET purchased_at=?,
+            period_days=?,
+            expires_at=?,
+            warn_2d_sent=0,
+            expired_sent=0,
+            keys_deleted=0
+        WHERE telegram_id=?
+    """, (start_ts, period_days, end_ts, user_id))
 
     return period_days
 
 
-async def _apply_latest_pending_payment_tariff(user_id: int) -> str | None:
+async def _apply_latest_pending_payment_tariff(db: aiosqlite.Connection, user_id: int) -> str | None:
     """
     Берём последнюю pending-оплату пользователя (если таблица payments есть),
     ставим её tariff в subscriptions, помечаем approved.
     """
-    if _DB_PATH is None:
-        raise RuntimeError("admin not setup")
-
     try:
-        async with aiosqlite.connect(_DB_PATH) as db:
-            cur = await db.execute(
-                "SELECT id, tariff FROM payments WHERE user_id=? AND status='pending' ORDER BY id DESC LIMIT 1",
-                (user_id,)
+        async with db.execute("""
+            UPDATE payments SET status='approved'
+            WHERE id = (
+                SELECT id FROM payments
+                WHERE user_id=? AND status='pending'
+                ORDER BY id DESC LIMIT 1
             )
+            RETURNING tariff
+        """, (user_id,)) as cur:
             row = await cur.fetchone()
-            if not row:
-                return None
-
-            payment_id, tariff_code = row
-            if tariff_code:
-                await _set_subscription_tariff(user_id, tariff_code)
+        if not row:
+            return None
 
-            await db.execute("UPDATE payments SET status='approved' WHERE id=?", (payment_id,))
-            await db.commit()
+        tariff_code = row[0]
+        if tariff_code:
+            await _set_subscription_tariff(db, user_id, tariff_code)
 
-            return tariff_code
+        return tariff_code
     except Exception:
         # если таблицы payments нет или другая ошибка — просто пропускаем
         return None
 
 
-async def _award_referrer_bonus_if_first_paid(user_id: int) -> int | None:
-    if _DB_PATH is None:
-        raise RuntimeError("admin not setup")
+async def _award_referrer_bonus_if_first_paid(db: aiosqlite.Connection, user_id: int) -> int | None:
+    now_ts = int(time.time())
 
-    now_iso = datetime.now(timezone.utc).isoformat()
-
-    async with aiosqlite.connect(_DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT referrer_id, ref_bonus_awarded, first_paid FROM users WHERE telegram_id=?",
-            (user_id,)
-        )
+    # first_paid ставим условно: строку вернёт только тот, кто реально перевёл 0 -> 1
+    async with db.execute("""
+        UPDATE users SET first_paid=1, first_paid_at=?
+        WHERE telegram_id=? AND IFNULL(first_paid, 0)=0
+        RETURNING referrer_id, ref_bonus_awarded
+    """, (now_ts, user_id)) as cur:
         row = await cur.fetchone()
-        if not row:
-            return None
-
-        referrer_id, ref_bonus_awarded, first_paid = row
-        ref_bonus_awarded = int(ref_bonus_awarded or 0)
-        first_paid = int(first_paid or 0)
-
-        if first_paid == 1:
-            return None
-
-        await db.execute(
-            "UPDATE users SET first_paid=1, first_paid_at=? WHERE telegram_id=?",
-            (now_iso, user_id)
-        )
-        await db.commit()
+    if not row:
+        # пользователя нет или первая оплата уже была
+        return None
 
-        if referrer_id is None or ref_bonus_awarded == 1:
-            return None
+    referrer_id, ref_bonus_awarded = row
+    if referrer_id is None or int(ref_bonus_awarded or 0) == 1:
+        return None
 
-    await _add_days(int(referrer_id), BONUS_DAYS_FOR_REFERRER)
+    cur = await db.execute(
+        "UPDATE users SET ref_bonus_awarded=1 WHERE telegram_id=? AND IFNULL(ref_bonus_awarded, 0)=0",
+        (user_id,)
+    )
+    if cur.rowcount != 1:
+        return None
 
-    async with aiosqlite.connect(_DB_PATH) as db:
-        await db.execute("UPDATE users SET ref_bonus_awarded=1 WHERE telegram_id=?", (user_id,))
-        await db.commit()
+    await _add_days(db, int(referrer_id), BONUS_DAYS_FOR_REFERRER)
 
     return int(referrer_id)
 
@@ -464,22 +514,23 @@ async def admin_users(callback: CallbackQuery):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    try:
-        offset = int(callback.data.split(":", 1)[1])
-    except Exception:
-        offset = 0
+    m = _ADMIN_USERS_RE.fullmatch(callback.data)
+    offset = int(m[1]) if m else 0
 
     total, users = await _list_users(offset, PAGE_SIZE)
 
-    lines = [f"👥 <b>Пользователи</b> (показано {len(users)} из {total})\n"]
+    lines = [_USERS_HEADER_TMPL.format(shown=len(users), total=total)]
     kb_rows = []
 
-    for uid, first, last, username, expires_at in users:
-        full_name = (f"{first or ''} {last or ''}").strip() or "Без имени"
-        uname = f"@{username}" if username else "—"
-        exp = _fmt(expires_at)
+    for uid, first, last, username, expires_at, has_outline, has_v2ray, has_amnezia in users:
+        full_name = utils.full_name(first, last)
 
-        lines.append(f"• <b>{full_name}</b> ({uname}) — до: <b>{exp}</b>")
+        lines.append(_USERS_ROW_TMPL.format_map({
+            "full_name": full_name,
+            "uname": f"@{username}" if username else "—",
+            "expires": utils.human_date(expires_at),
+            "keys_mark": " 🔑" if (has_outline or has_v2ray or has_amnezia) else "",
+        }))
         kb_rows.append([InlineKeyboardButton(text=f"Управлять: {full_name}", callback_data=f"admin_user:{uid}")])
 
     nav = users_list_kb(offset, total)
@@ -495,40 +546,33 @@ async def admin_user(callback: CallbackQuery):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    try:
-        user_id = int(callback.data.split(":", 1)[1])
-    except Exception:
+    m = _ADMIN_USER_RE.fullmatch(callback.data)
+    if not m:
         await callback.answer("Некорректный ID", show_alert=True)
         return
+    user_id = int(m[1])
 
     row = await _get_user(user_id)
     if not row:
         await callback.answer("Пользователь не найден", show_alert=True)
         return
 
-    uid, first, last, username, created_at, first_paid, first_paid_at, purchased_at, period_days, expires_at, tariff = row
-    full_name = (f"{first or ''} {last or ''}").strip() or "Без имени"
-    uname = f"@{username}" if username else "—"
-
-    outline_key, v2ray_key, amnezia_key = await _get_keys(uid)
-
-    text = (
-        "👤 <b>Управление пользователем</b>\n\n"
-        f"• Имя: <b>{full_name}</b>\n"
-        f"• Username: <b>{uname}</b>\n"
-        f"• ID: <code>{uid}</code>\n"
-        f"• Регистрация: <b>{_fmt(created_at)}</b>\n"
-        f"• Первая оплата: <b>{_fmt(first_paid_at) if int(first_paid or 0) == 1 else '—'}</b>\n\n"
-        "🔐 <b>Подписка</b>\n"
-        f"• Тариф: <b>{_tariff_title(tariff)}</b>\n"
-        f"• Оформление: <b>{_fmt(purchased_at)}</b>\n"
-        f"• Период (дней): <b>{period_days if period_days else '—'}</b>\n"
-        f"• Действует до: <b>{_fmt(expires_at)}</b>\n\n"
-        "🔑 <b>Ключи</b>\n"
-        f"• OutLine: <b>{'✅ выдан' if outline_key else '—'}</b>\n"
-        f"• v2raytun: <b>{'✅ выдан' if v2ray_key else '—'}</b>\n"
-        f"• AmneziaVPN: <b>{'✅ выдан' if amnezia_key else '—'}</b>\n"
-    )
+    (uid, first, last, username, created_at, first_paid, first_paid_at, purchased_at, period_days, expires_at, tariff,
+     has_outline, has_v2ray, has_amnezia) = row
+    text = _USER_CARD_TMPL.format_map({
+        "full_name": utils.full_name(first, last),
+        "uname": f"@{username}" if username else "—",
+        "uid": uid,
+        "created": utils.human_date(created_at),
+        "first_paid": utils.human_date(first_paid_at) if int(first_paid or 0) == 1 else "—",
+        "tariff": _tariff_title(tariff),
+        "purchased": utils.human_date(purchased_at),
+        "period": period_days if period_days else "—",
+        "expires": utils.human_date(expires_at),
+        "outline": _KEY_MARK[bool(has_outline)],
+        "v2ray": _KEY_MARK[bool(has_v2ray)],
+        "amnezia": _KEY_MARK[bool(has_amnezia)],
+    })
 
     await callback.message.answer(text, reply_markup=user_manage_kb(uid), parse_mode=ParseMode.HTML)
     await callback.answer()
@@ -540,11 +584,11 @@ async def admin_tariff(callback: CallbackQuery):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    try:
-        user_id = int(callback.data.split(":", 1)[1])
-    except Exception:
+    m = _ADMIN_TARIFF_RE.fullmatch(callback.data)
+    if not m:
         await callback.answer("Некорректная команда", show_alert=True)
         return
+    user_id = int(m[1])
 
     row = await _get_user(user_id)
     if not row:
@@ -552,7 +596,7 @@ async def admin_tariff(callback: CallbackQuery):
         return
 
     uid, first, last, *_rest = row
-    full_name = (f"{first or ''} {last or ''}").strip() or "Без имени"
+    full_name = utils.full_name(first, last)
 
     await callback.message.answer(
         f"🧾 Выберите тариф для пользователя <b>{full_name}</b> (ID: <code>{uid}</code>):",
@@ -568,16 +612,15 @@ async def admin_set_tariff(callback: CallbackQuery):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    try:
-        _, user_id_str, tariff_code = callback.data.split(":")
-        user_id = int(user_id_str)
-        if tariff_code not in TARIFFS:
-            raise ValueError()
-    except Exception:
+    m = _ADMIN_SET_TARIFF_RE.fullmatch(callback.data)
+    if not m:
         await callback.answer("Некорректная команда", show_alert=True)
         return
+    user_id, tariff_code = int(m[1]), m[2]
 
-    await _set_subscription_tariff(user_id, tariff_code)
+    async with database.transaction() as db:
+        await _set_subscription_tariff(db, user_id, tariff_code)
+    _invalidate_stats()
 
     # уведомим пользователя (полезно)
     try:
@@ -603,11 +646,11 @@ async def admin_period_start(callback: CallbackQuery, state: FSMContext):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    try:
-        user_id = int(callback.data.split(":", 1)[1])
-    except Exception:
+    m = _ADMIN_PERIOD_RE.fullmatch(callback.data)
+    if not m:
         await callback.answer("Некорректная команда", show_alert=True)
         return
+    user_id = int(m[1])
 
     row = await _get_user(user_id)
     if not row:
@@ -615,7 +658,7 @@ async def admin_period_start(callback: CallbackQuery, state: FSMContext):
         return
 
     uid, first, last, *_ = row
-    full_name = (f"{first or ''} {last or ''}").strip() or "Без имени"
+    full_name = utils.full_name(first, last)
 
     await state.set_state(AdminPeriodStates.waiting_period)
     await state.update_data(target_user_id=user_id)
@@ -635,55 +678,52 @@ async def admin_add(callback: CallbackQuery):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    try:
-        _, user_id_str, months_str = callback.data.split(":")
-        user_id = int(user_id_str)
-        months = int(months_str)
-        if months not in (1, 2, 3, 6, 12):
-            raise ValueError()
-    except Exception:
+    m = _ADMIN_ADD_RE.fullmatch(callback.data)
+    if not m:
         await callback.answer("Некорректная команда", show_alert=True)
         return
+    user_id, months = int(m[1]), int(m[2])
+
+    # вся запись — одной транзакцией: один commit и атомарность бонуса/подтверждения оплаты
+    async with database.transaction() as db:
+        # начисляем период
+        added_days, expires_at, tariff = await _add_months(db, user_id, months)
+
+        # если пользователь оплатил через pay.py — подтянем выбранный тариф из pending оплаты
+        tariff = await _apply_latest_pending_payment_tariff(db, user_id) or tariff
 
-    # начисляем период
-    added_days = await _add_months(user_id, months)
+        # реферальный бонус (только при первой оплате)
+        referrer_id = await _award_referrer_bonus_if_first_paid(db, user_id)
+    _invalidate_stats()
+    # срок подписки изменился — watcher перепроверит сразу, не дожидаясь тика
+    database.WAKE_EVENT.set()
 
-    # если пользователь оплатил через pay.py — подтянем выбранный тариф из pending оплаты
-    await _apply_latest_pending_payment_tariff(user_id)
+    # уведомление пользователю: оплата успешна + начислено дней
+    # срок и тариф уже известны из UPSERT — повторно карточку не читаем
+    sends = [callback.bot.send_message(
+        user_id,
+        "✅ <b>Оплата успешно подтверждена</b>\n\n"
+        f"Вам начислено: <b>+{added_days} дней</b>\n"
+        f"Тариф: <b>{_tariff_title(tariff)}</b>\n"
+        f"Подписка действует до: <b>{utils.human_date(expires_at)}</b>",
+        parse_mode=ParseMode.HTML
+    )]
 
-    # реферальный бонус (только при первой оплате)
-    referrer_id = await _award_referrer_bonus_if_first_paid(user_id)
     if referrer_id:
         row = await _get_user(user_id)
         if row:
             uid, first, last, *_ = row
-            full_name = (f"{first or ''} {last or ''}").strip() or "Без имени"
+            full_name = utils.full_name(first, last)
             mention = f'<a href="tg://user?id={uid}">{full_name}</a>'
-            try:
-                await callback.bot.send_message(
-                    referrer_id,
-                    f"💳 Ваш реферал {mention} оплатил первый месяц.\n"
-                    f"🎁 Вам начислено <b>{BONUS_DAYS_FOR_REFERRER} дней</b> бесплатной подписки.",
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception:
-                pass
-
-    # уведомление пользователю: оплата успешна + начислено дней
-    row = await _get_user(user_id)
-    if row:
-        uid, first, last, username, created_at, first_paid, first_paid_at, purchased_at, period_days, expires_at, tariff = row
-        try:
-            await callback.bot.send_message(
-                user_id,
-                "✅ <b>Оплата успешно подтверждена</b>\n\n"
-                f"Вам начислено: <b>+{added_days} дней</b>\n"
-                f"Тариф: <b>{_tariff_title(tariff)}</b>\n"
-                f"Подписка действует до: <b>{_fmt(expires_at)}</b>",
+            sends.append(callback.bot.send_message(
+                referrer_id,
+                f"💳 Ваш реферал {mention} оплатил первый месяц.\n"
+                f"🎁 Вам начислено <b>{BONUS_DAYS_FOR_REFERRER} дней</b> бесплатной подписки.",
                 parse_mode=ParseMode.HTML
-            )
-        except Exception:
-            pass
+            ))
+
+    # пользователю и рефереру — параллельно; ошибки доставки (бот заблокирован и т.п.) не важны
+    await asyncio.gather(*sends, return_exceptions=True)
 
     await callback.message.answer("✅ Подписка обновлена.", reply_markup=user_manage_kb(user_id), parse_mode=ParseMode.HTML)
     await callback.answer()
@@ -695,14 +735,11 @@ async def admin_key_start(callback: CallbackQuery, state: FSMContext):
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    try:
-        _, user_id_str, key_type = callback.data.split(":")
-        user_id = int(user_id_str)
-        if key_type not in ("outline", "v2ray", "amnezia"):
-            raise ValueError()
-    except Exception:
+    m = _ADMIN_KEY_RE.fullmatch(callback.data)
+    if not m:
         await callback.answer("Некорректная команда", show_alert=True)
         return
+    user_id, key_type = int(m[1]), m[2]
 
     row = await _get_user(user_id)
     if not row:
@@ -710,7 +747,7 @@ async def admin_key_start(callback: CallbackQuery, state: FSMContext):
         return
 
     uid, first, last, *_ = row
-    full_name = (f"{first or ''} {last or ''}").strip() or "Без имени"
+    full_name = utils.full_name(first, last)
     key_name = _key_title(key_type)
 
     await state.set_state(AdminKeyStates.waiting_key)
@@ -742,13 +779,21 @@ async def admin_key_receive(message: Message, state: FSMContext):
     data = await state.get_data()
     user_id = int(data.get("target_user_id", 0))
     key_type = data.get("key_type")
+    if key_type not in _KEY_TYPES:
+        await message.answer("Некорректный тип ключа. Начните заново из карточки пользователя.")
+        await state.clear()
+        return
 
     key_value = (message.text or "").strip()
-    if not key_value or len(key_value) < 5:
-        await message.answer("Ключ выглядит пустым/слишком коротким. Отправьте ключ текстом одним сообщением.")
+    if not _KEY_RE[key_type].match(key_value):
+        await message.answer(
+            f"Ключ не похож на {_key_title(key_type)} (ожидается {_KEY_HINTS[key_type]}). "
+            "Отправьте ключ текстом одним сообщением."
+        )
         return
 
-    await _set_key(user_id, key_type, key_value, message.from_user.id)
+    async with database.transaction() as db:
+        await _set_key(db, user_id, key_type, key_value, message.from_user.id)
     await state.clear()
 
     key_name = _key_title(key_type)
@@ -788,7 +833,10 @@ async def admin_period_receive(message: Message, state: FSMContext):
         return
 
     start_dt, end_dt = parsed
-    period_days = await _set_period_range(user_id, start_dt, end_dt)
+    async with database.transaction() as db:
+        period_days = await _set_period_range(db, user_id, start_dt, end_dt)
+    _invalidate_stats()
+    database.WAKE_EVENT.set()
     await state.clear()
 
     start_human = start_dt.strftime("%d.%m.%Y")
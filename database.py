@@ -0,0 +1,170 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+# Долгоживущие подключения на весь бот (main/admin/pay):
+# без потока и open/PRAGMA-рутины на каждый запрос, кэш страниц SQLite остаётся тёплым.
+# SQLite допускает одного писателя, поэтому запись идёт через одно подключение под WRITE_LOCK,
+# а чтение — через небольшой пул read-only подключений (в WAL читатели не ждут писателя).
+_DB: aiosqlite.Connection | None = None
+_READERS: asyncio.Queue | None = None
+_READER_CONNS: list[aiosqlite.Connection] = []
+
+WRITE_LOCK = asyncio.Lock()
+READER_POOL_SIZE = 4
+
+# будит subscription_watcher после изменения подписок; ставить только после commit,
+# иначе watcher может прочитать ещё старые данные
+WAKE_EVENT = asyncio.Event()
+
+_DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    # писатели сериализованы WRITE_LOCK; таймаут нужен против подключений пула читателей
+    # (checkpoint WAL, смена режима журнала) — ждём до 5 с вместо "database is locked"
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    # до 256 МБ файла читаются через mmap, без копирования страниц в буфер
+    "PRAGMA mmap_size=268435456",
+)
+
+_READER_PRAGMAS = (
+    "PRAGMA query_only=true",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+async def _open(db_path: str, pragmas: tuple[str, ...], **kwargs) -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(db_path, **kwargs)
+    # PRAGMA выполняются один раз на подключение, а не на каждый запрос
+    for pragma in pragmas:
+        await conn.execute(pragma)
+    await conn.commit()
+    return conn
+
+
+async def connect(db_path: str) -> None:
+    global _DB, _READERS
+    if _DB is not None:
+        return
+    # писатель первым: он переводит файл в WAL, читатели открываются уже в этом режиме
+    _DB = await _open(db_path, _DB_PRAGMAS)
+
+    _READERS = asyncio.Queue()
+    for _ in range(READER_POOL_SIZE):
+        # autocommit: читатель не держит неявную транзакцию и не застревает на старом снимке WAL
+        conn = await _open(db_path, _READER_PRAGMAS, isolation_level=None)
+        _READER_CONNS.append(conn)
+        _READERS.put_nowait(conn)
+
+
+async def close() -> None:
+    global _DB, _READERS
+    for conn in _READER_CONNS:
+        await conn.close()
+    _READER_CONNS.clear()
+    _READERS = None
+
+    if _DB is not None:
+        await _DB.close()
+        _DB = None
+
+
+@asynccontextmanager
+async def connection():
+    """
+    Read-only подключение из пула (PRAGMA query_only).
+    Видит только закоммиченные данные; для записи используйте transaction().
+    """
+    if _READERS is None:
+        raise RuntimeError("database not setup: call database.connect() first")
+
+    conn = await _READERS.get()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            await conn.rollback()
+        _READERS.put_nowait(conn)
+
+
+@asynccontextmanager
+async def transaction():
+    """
+    Атомарная запись через подключение-писатель.
+    WRITE_LOCK сериализует писателей: чужой commit не закроет нашу транзакцию посередине,
+    а SQLite не приходится разруливать конкурентную запись через busy_timeout.
+    """
+    if _DB is None:
+        raise RuntimeError("database not setup: call database.connect() first")
+
+    async with WRITE_LOCK:
+        await _DB.execute("BEGIN IMMEDIATE")
+        try:
+            yield _DB
+            # commit внутри try: если он упадёт (BUSY, I/O), откат закроет BEGIN IMMEDIATE,
+            # иначе писатель так и останется в транзакции до перезапуска
+            await _DB.commit()
+        except BaseException:
+            await _DB.rollback()
+            raise
+
+
+async def add_missing_columns(db: aiosqlite.Connection, table: str, columns: dict[str, str]) -> set[str]:
+    """
+    Миграция: ALTER TABLE ... ADD COLUMN только для колонок, которых ещё нет.
+    Один PRAGMA table_info вместо ALTER-ов, падающих на каждом перезапуске.
+    Вызывать внутри transaction(): все ALTER-ы ложатся на диск одним commit.
+    Возвращает имена добавленных колонок — для заполнения их по старым данным.
+    """
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in await cur.fetchall()}
+    added = set()
+    for name, decl in columns.items():
+        if name not in existing:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+            added.add(name)
+    return added
+
+
+async def convert_column_to_epoch(db: aiosqlite.Connection, table: str, column: str) -> bool:
+    """
+    Миграция: колонку с ISO-строками (TEXT) переводит в INTEGER unix-секунды.
+    Возвращает True, если конвертация была; для уже целочисленной колонки ничего не делает.
+    Индексы по колонке нужно удалить заранее — с ними DROP COLUMN не пройдёт.
+    Вызывать внутри transaction(): при ошибке старая колонка остаётся как была.
+    """
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    info = {name: ((col_type or "").upper(), notnull) for _, name, col_type, notnull, *_ in await cur.fetchall()}
+    col_type, notnull = info.get(column, ("", 0))
+    if col_type != "TEXT":
+        return False
+
+    # сначала проверяем, что все даты разбираются: иначе они молча стали бы NULL/0.
+    # Пустая строка в nullable-колонке — просто «даты нет»
+    empty_ok = "" if notnull else f" AND {column} <> ''"
+    cur = await db.execute(f"""
+        SELECT COUNT(*) FROM {table}
+        WHERE {column} IS NOT NULL{empty_ok} AND strftime('%s', {column}) IS NULL
+    """)
+    (bad,) = await cur.fetchone()
+    if bad:
+        raise RuntimeError(f"{table}.{column}: {bad} values are not ISO dates, migration aborted")
+
+    # NOT NULL переносим: ADD COLUMN принимает его только вместе с DEFAULT,
+    # а после заполнения ниже ни одна строка на значении по умолчанию не остаётся
+    decl = "INTEGER NOT NULL DEFAULT 0" if notnull else "INTEGER"
+    await db.execute(f"ALTER TABLE {table} ADD COLUMN {column}_ts {decl}")
+    await db.execute(f"""
+        UPDATE {table} SET {column}_ts = CAST(strftime('%s', {column}) AS INTEGER)
+        WHERE {column} IS NOT NULL AND {column} <> ''
+    """)
+
+    await db.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+    await db.execute(f"ALTER TABLE {table} RENAME COLUMN {column}_ts TO {column}")
+    return True
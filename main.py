@@ -1,6 +1,9 @@
 import os
 import asyncio
-from datetime import datetime, timezone, timedelta
+import functools
+import time
+from datetime import timedelta
+from types import MappingProxyType
 
 import aiosqlite
 from dotenv import load_dotenv
@@ -14,9 +17,11 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.storage.memory import MemoryStorage
 
 import admin
+import database
 import pay
 import referrals
 import tariffs  # новый файл tariffs.py
+import utils
 
 load_dotenv()
 
@@ -26,107 +31,156 @@ DB_PATH = "bot.db"
 REFERRER_BONUS_DAYS = 14
 INVITEE_TRIAL_DAYS = 3
 
-# Отображение тарифа в кабинете
-TARIFF_TITLES = {
+# Отображение тарифа в кабинете (только чтение)
+TARIFF_TITLES = MappingProxyType({
     "outline": "OutLine",
     "v2ray": "v2raytun",
     "bundle": "OutLine/V2RayTun + AmneziaVPN",
-}
+})
 
 # Уведомления по подписке
 CHECK_INTERVAL_SECONDS = 15 * 60         # каждые 15 минут
 WARN_BEFORE = timedelta(days=2)          # предупреждать за 2 дня
 GRACE_AFTER_EXPIRE = timedelta(days=2)   # 2 дня после конца, потом удаляем ключи
+WARN_BEFORE_SECONDS = int(WARN_BEFORE.total_seconds())
+GRACE_AFTER_EXPIRE_SECONDS = int(GRACE_AFTER_EXPIRE.total_seconds())
+
+# версия схемы БД (PRAGMA user_version): 1 — ALTER-миграции колонок, 2 — даты в unix-секундах,
+# 3 — referrals.ensure_referrals_schema (заполнение paid_referrals_count и триггер trg_ref_bonus)
+SCHEMA_VERSION = 3
+
+# даты, которые хранятся как INTEGER unix-секунды (UTC)
+EPOCH_COLUMNS = (
+    ("users", "created_at"),
+    ("users", "first_paid_at"),
+    ("subscriptions", "purchased_at"),
+    ("subscriptions", "expires_at"),
+    ("user_keys", "updated_at"),
+)
+
+# шаблон кабинета: постоянные части (бонусы рефералки) подставлены один раз при импорте
+CABINET_TMPL = (
+    "👤 <b>Личный кабинет</b>\n\n"
+    "• Имя и Фамилия: <b>{full_name}</b>\n"
+    "• Username: <b>@{username}</b>\n"
+    "• Регистрация: <b>{created}</b>\n\n"
+    "🔐 <b>VPN-подписка</b>\n"
+    "• Тариф: <b>{tariff}</b>\n"
+    "• Дата оформления: <b>{purchased}</b>\n"
+    "• Период: <b>{period}</b>\n"
+    "• Действует до: <b>{expires}</b>\n\n"
+    "{keys_block}"
+    "👥 <b>Рефералы:</b> <b>{refs_count}</b>\n"
+    f"🎁 Реферал получает: <b>+{INVITEE_TRIAL_DAYS} дня</b>\n"
+    f"🏆 Вы получаете: <b>+{REFERRER_BONUS_DAYS} дней</b> после <b>первой оплаты</b> реферала\n"
+)
+
+
+def _keys_block(has_outline: bool, has_v2ray: bool, has_amnezia: bool) -> str:
+    if not (has_outline or has_v2ray or has_amnezia):
+        return "⏳ <b>Ожидайте когда администратор выдаст ключ</b>\n\n"
+    lines = ["🔑 <b>Ключи</b>"]
+    if has_outline:
+        lines.append("• OutLine: <b>выдан</b>")
+    if has_v2ray:
+        lines.append("• v2raytun: <b>выдан</b>")
+    if has_amnezia:
+        lines.append("• AmneziaVPN: <b>выдан</b>")
+    return "\n".join(lines) + "\n\n"
+
+
+# всего 8 вариантов блока ключей — собираем их заранее
+KEYS_BLOCKS = {
+    (o, v, a): _keys_block(o, v, a)
+    for o in (False, True) for v in (False, True) for a in (False, True)
+}
 
 
 # ---------------- Keyboards ----------------
 
+# Клавиатуры — pydantic-модели aiogram: неизменные собираем один раз при импорте.
+_START_KB_USER = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Личный кабинет", callback_data="cabinet")],
+])
+_START_KB_ADMIN = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Личный кабинет", callback_data="cabinet")],
+    [InlineKeyboardButton(text="Панель управления", callback_data="admin_panel")],
+])
+
+_CABINET_ROWS = (
+    [InlineKeyboardButton(text="Оплатить", callback_data="pay")],
+    [InlineKeyboardButton(text="Тарифы", callback_data="tariffs")],
+    [InlineKeyboardButton(text="Реферальная ссылка", callback_data="ref_link")],
+    [InlineKeyboardButton(text="Рефералы", callback_data="refs")],
+)
+_SHOW_OUTLINE_ROW = [InlineKeyboardButton(text="🔑 Показать ключ OutLine", callback_data="show_outline_key")]
+_SHOW_V2RAY_ROW = [InlineKeyboardButton(text="🔑 Показать ключ v2raytun", callback_data="show_v2ray_key")]
+_SHOW_AMNEZIA_ROW = [InlineKeyboardButton(text="🔑 Показать ключ AmneziaVPN", callback_data="show_amnezia_key")]
+
+
 def start_kb(is_admin_user: bool) -> InlineKeyboardMarkup:
-    rows = [[InlineKeyboardButton(text="Личный кабинет", callback_data="cabinet")]]
-    if is_admin_user:
-        rows.append([InlineKeyboardButton(text="Панель управления", callback_data="admin_panel")])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+    return _START_KB_ADMIN if is_admin_user else _START_KB_USER
 
 
 def cabinet_actions_kb(outline_key: str | None, v2ray_key: str | None, amnezia_key: str | None) -> InlineKeyboardMarkup:
-    kb = [
-        [InlineKeyboardButton(text="Оплатить", callback_data="pay")],
-        [InlineKeyboardButton(text="Тарифы", callback_data="tariffs")],
-        [InlineKeyboardButton(text="Реферальная ссылка", callback_data="ref_link")],
-        [InlineKeyboardButton(text="Рефералы", callback_data="refs")],
-    ]
+    return _cabinet_actions_kb(bool(outline_key), bool(v2ray_key), bool(amnezia_key))
+
+
+@functools.lru_cache(maxsize=8)
+def _cabinet_actions_kb(has_outline: bool, has_v2ray: bool, has_amnezia: bool) -> InlineKeyboardMarkup:
+    kb = list(_CABINET_ROWS)
 
     # кнопки ключей показываем ТОЛЬКО если ключ существует
-    if outline_key:
-        kb.append([InlineKeyboardButton(text="🔑 Показать ключ OutLine", callback_data="show_outline_key")])
-    if v2ray_key:
-        kb.append([InlineKeyboardButton(text="🔑 Показать ключ v2raytun", callback_data="show_v2ray_key")])
-    if amnezia_key:
-        kb.append([InlineKeyboardButton(text="🔑 Показать ключ AmneziaVPN", callback_data="show_amnezia_key")])
+    if has_outline:
+        kb.append(_SHOW_OUTLINE_ROW)
+    if has_v2ray:
+        kb.append(_SHOW_V2RAY_ROW)
+    if has_amnezia:
+        kb.append(_SHOW_AMNEZIA_ROW)
 
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
 
 # ---------------- Helpers ----------------
 
-def human_date(dt_iso: str | None) -> str:
-    if not dt_iso:
-        return "—"
-    try:
-        dt = datetime.fromisoformat(dt_iso)
-        return dt.strftime("%d.%m.%Y %H:%M")
-    except Exception:
-        return dt_iso
-
-
-def parse_admin_ids(env_value: str | None) -> set[int]:
+def parse_admin_ids(env_value: str | None) -> frozenset[int]:
     if not env_value:
-        return set()
-    out = set()
-    for part in env_value.split(","):
-        part = part.strip()
-        if not part:
-            continue
-        try:
-            out.add(int(part))
-        except ValueError:
-            pass
-    return out
+        return frozenset()
+    # один проход без try/except: пустые и нечисловые элементы просто пропускаем;
+    # знак снимаем не больше одного раза — "--5" не число, а int() на нём упал бы
+    parts = (part.strip() for part in env_value.split(","))
+    return frozenset(int(part) for part in parts if _unsigned(part).isdecimal())
 
 
-def _parse_iso(dt_iso: str | None) -> datetime | None:
-    if not dt_iso:
-        return None
-    try:
-        return datetime.fromisoformat(dt_iso)
-    except Exception:
-        return None
+def _unsigned(part: str) -> str:
+    return part[1:] if part[:1] in ("+", "-") else part
 
 
 # ---------------- DB ----------------
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with database.transaction() as db:
         await db.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 telegram_id INTEGER PRIMARY KEY,
                 first_name TEXT,
                 last_name TEXT,
                 username TEXT,
-                created_at TEXT,
+                created_at INTEGER,
                 referrer_id INTEGER,
                 ref_bonus_awarded INTEGER DEFAULT 0,
                 first_paid INTEGER DEFAULT 0,
-                first_paid_at TEXT
+                first_paid_at INTEGER,
+                paid_referrals_count INTEGER DEFAULT 0
             )
         """)
 
         await db.execute("""
             CREATE TABLE IF NOT EXISTS subscriptions (
                 telegram_id INTEGER PRIMARY KEY,
-                purchased_at TEXT,
+                purchased_at INTEGER,
                 period_days INTEGER,
-                expires_at TEXT,
+                expires_at INTEGER,
                 tariff TEXT,
                 warn_2d_sent INTEGER DEFAULT 0,
                 expired_sent INTEGER DEFAULT 0,
@@ -141,75 +195,111 @@ async def init_db():
                 outline_key TEXT,
                 v2ray_key TEXT,
                 amnezia_key TEXT,
-                updated_at TEXT,
+                updated_at INTEGER,
                 updated_by INTEGER
             )
         """)
 
         # --- migrations for older DBs ---
-        migrations = [
-            "ALTER TABLE users ADD COLUMN referrer_id INTEGER",
-            "ALTER TABLE users ADD COLUMN ref_bonus_awarded INTEGER DEFAULT 0",
-            "ALTER TABLE users ADD COLUMN first_paid INTEGER DEFAULT 0",
-            "ALTER TABLE users ADD COLUMN first_paid_at TEXT",
-
-            "ALTER TABLE subscriptions ADD COLUMN tariff TEXT",
-            "ALTER TABLE subscriptions ADD COLUMN warn_2d_sent INTEGER DEFAULT 0",
-            "ALTER TABLE subscriptions ADD COLUMN expired_sent INTEGER DEFAULT 0",
-            "ALTER TABLE subscriptions ADD COLUMN keys_deleted INTEGER DEFAULT 0",
-
-            "ALTER TABLE user_keys ADD COLUMN amnezia_key TEXT",
-        ]
-        for sql in migrations:
-            try:
-                await db.execute(sql)
-            except Exception:
-                pass
-
-        await referrals.ensure_referrals_schema(db)
-        await db.commit()
-
-
-async def user_exists(user_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT 1 FROM users WHERE telegram_id=? LIMIT 1", (user_id,))
-        row = await cur.fetchone()
-    return bool(row)
+        # выполняются один раз: версия схемы хранится в PRAGMA user_version
+        cur = await db.execute("PRAGMA user_version")
+        (version,) = await cur.fetchone()
+
+        if version < 1:
+            await database.add_missing_columns(db, "subscriptions", {
+                "tariff": "TEXT",
+                "warn_2d_sent": "INTEGER DEFAULT 0",
+                "expired_sent": "INTEGER DEFAULT 0",
+                "keys_deleted": "INTEGER DEFAULT 0",
+            })
+            await database.add_missing_columns(db, "user_keys", {"amnezia_key": "TEXT"})
+
+        if version < 2:
+            await migrate_timestamps_to_epoch(db)
+            await db.execute("DROP INDEX IF EXISTS idx_sub_expires")
+
+        if version < 3:
+            # колонки рефералки, paid_referrals_count и триггер — после перевода дат в epoch,
+            # чтобы DROP COLUMN в миграции не упирался в триггер на users
+            await referrals.ensure_referrals_schema(db)
+
+        if version < SCHEMA_VERSION:
+            await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+        # частичный индекс: строки без срока в него не попадают, watcher и счётчики идут по диапазону
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_subs_expires ON subscriptions(expires_at) WHERE expires_at IS NOT NULL"
+        )
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at DESC)")
+        # список рефералов (WHERE referrer_id=? ORDER BY created_at DESC) — диапазон по индексу без сортировки
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_referrer_created ON users(referrer_id, created_at DESC)"
+        )
 
 
-async def upsert_user(telegram_id: int, first_name: str, last_name: str, username: str | None):
-    now = datetime.now(timezone.utc).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO users(telegram_id, first_name, last_name, username, created_at)
+async def migrate_timestamps_to_epoch(db: aiosqlite.Connection) -> None:
+    """
+    Старые БД хранили даты ISO-строками (TEXT). Переводим их в INTEGER unix-секунды:
+    сравнения в SQL становятся целочисленными, строки короче.
+    """
+    # индексы по этим колонкам мешают DROP COLUMN — они пересоздаются в init_db
+    for index in ("idx_sub_expires", "idx_subs_expires", "idx_users_created", "idx_users_referrer_created"):
+        await db.execute(f"DROP INDEX IF EXISTS {index}")
+
+    for table, column in EPOCH_COLUMNS:
+        await database.convert_column_to_epoch(db, table, column)
+
+
+async def upsert_user(telegram_id: int, first_name: str, last_name: str, username: str | None) -> bool:
+    """
+    Создаёт пользователя или обновляет имя/username.
+    Возвращает True, если пользователь новый — отдельный SELECT перед /start не нужен.
+    """
+    now = int(time.time())
+    async with database.transaction() as db:
+        cur = await db.execute("""
+            INSERT OR IGNORE INTO users(telegram_id, first_name, last_name, username, created_at)
             VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(telegram_id) DO UPDATE SET
-                first_name=excluded.first_name,
-                last_name=excluded.last_name,
-                username=excluded.username
         """, (telegram_id, first_name, last_name, username or "", now))
-        await db.commit()
+        if cur.rowcount == 1:
+            return True
 
+        await db.execute("""
+            UPDATE users SET first_name=?, last_name=?, username=?
+            WHERE telegram_id=?
+        """, (first_name, last_name, username or "", telegram_id))
+    return False
 
-async def get_user_and_sub(telegram_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        user_cur = await db.execute(
-            "SELECT telegram_id, first_name, last_name, username, created_at FROM users WHERE telegram_id=?",
-            (telegram_id,)
-        )
-        user = await user_cur.fetchone()
 
-        sub_cur = await db.execute(
-            "SELECT purchased_at, period_days, expires_at, tariff FROM subscriptions WHERE telegram_id=?",
-            (telegram_id,)
-        )
-        sub = await sub_cur.fetchone()
+async def get_cabinet(telegram_id: int):
+    """
+    Всё для личного кабинета одним запросом:
+    (user, sub, (outline_key, v2ray_key, amnezia_key), refs_count).
+    s.telegram_id показывает, есть ли строка подписки.
+    """
+    async with database.connection() as db:
+        cur = await db.execute("""
+            SELECT u.telegram_id, u.first_name, u.last_name, u.username, u.created_at,
+                   s.telegram_id, s.purchased_at, s.period_days, s.expires_at, s.tariff,
+                   k.outline_key, k.v2ray_key, k.amnezia_key,
+                   (SELECT COUNT(*) FROM users r WHERE r.referrer_id = u.telegram_id)
+            FROM users u
+            LEFT JOIN subscriptions s ON s.telegram_id = u.telegram_id
+            LEFT JOIN user_keys k ON k.user_id = u.telegram_id
+            WHERE u.telegram_id=?
+        """, (telegram_id,))
+        row = await cur.fetchone()
+
+    if not row:
+        return None, None, (None, None, None), 0
 
-    return user, sub
+    user = row[:5]
+    sub = row[6:10] if row[5] is not None else None
+    return user, sub, row[10:13], int(row[13])
 
 
 async def get_keys(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with database.connection() as db:
         cur = await db.execute(
             "SELECT outline_key, v2ray_key, amnezia_key FROM user_keys WHERE user_id=?",
             (user_id,)
@@ -238,40 +328,21 @@ def cabinet_text(
     else:
         purchased_at, period_days, expires_at, tariff_code = None, None, None, None
 
-    full_name = (first_name + " " + last_name).strip() or "—"
-    tariff_title = TARIFF_TITLES.get(tariff_code, "—")
-
-    if not outline_key and not v2ray_key and not amnezia_key:
-        keys_block = "⏳ <b>Ожидайте когда администратор выдаст ключ</b>\n\n"
-    else:
-        lines = ["🔑 <b>Ключи</b>"]
-        if outline_key:
-            lines.append("• OutLine: <b>выдан</b>")
-        if v2ray_key:
-            lines.append("• v2raytun: <b>выдан</b>")
-        if amnezia_key:
-            lines.append("• AmneziaVPN: <b>выдан</b>")
-        keys_block = "\n".join(lines) + "\n\n"
-
-    return (
-        "👤 <b>Личный кабинет</b>\n\n"
-        f"• Имя и Фамилия: <b>{full_name}</b>\n"
-        f"• Username: <b>@{username}</b>\n"
-        f"• Регистрация: <b>{human_date(created_at)}</b>\n\n"
-        "🔐 <b>VPN-подписка</b>\n"
-        f"• Тариф: <b>{tariff_title}</b>\n"
-        f"• Дата оформления: <b>{human_date(purchased_at)}</b>\n"
-        f"• Период: <b>{(str(period_days) + ' дней') if period_days else '—'}</b>\n"
-        f"• Действует до: <b>{human_date(expires_at)}</b>\n\n"
-        f"{keys_block}"
-        f"👥 <b>Рефералы:</b> <b>{refs_count}</b>\n"
-        f"🎁 Реферал получает: <b>+{INVITEE_TRIAL_DAYS} дня</b>\n"
-        f"🏆 Вы получаете: <b>+{REFERRER_BONUS_DAYS} дней</b> после <b>первой оплаты</b> реферала\n"
-    )
-
-
-async def notify_admins_new_user(bot: Bot, admin_ids: set[int], user_msg: Message):
-    full_name = " ".join([p for p in [user_msg.from_user.first_name, user_msg.from_user.last_name] if p]).strip() or "Без имени"
+    return CABINET_TMPL.format_map({
+        "full_name": (first_name + " " + last_name).strip() or "—",
+        "username": username,
+        "created": utils.human_date(created_at),
+        "tariff": TARIFF_TITLES.get(tariff_code, "—"),
+        "purchased": utils.human_date(purchased_at),
+        "period": f"{period_days} дней" if period_days else "—",
+        "expires": utils.human_date(expires_at),
+        "keys_block": KEYS_BLOCKS[bool(outline_key), bool(v2ray_key), bool(amnezia_key)],
+        "refs_count": refs_count,
+    })
+
+
+async def notify_admins_new_user(bot: Bot, admin_ids: frozenset[int], user_msg: Message):
+    full_name = utils.full_name(user_msg.from_user.first_name, user_msg.from_user.last_name)
     mention = f'<a href="tg://user?id={user_msg.from_user.id}">{full_name}</a>'
     text = (
         "🆕 <b>Новый пользователь</b>\n\n"
@@ -282,112 +353,150 @@ async def notify_admins_new_user(bot: Bot, admin_ids: set[int], user_msg: Messag
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🛠 Управление пользователем", callback_data=f"admin_user:{user_msg.from_user.id}")]
     ])
-    for admin_id in admin_ids:
-        try:
-            await bot.send_message(admin_id, text, reply_markup=kb, parse_mode=ParseMode.HTML)
-        except Exception:
-            pass
+    # всем админам параллельно: чужая ошибка доставки не мешает остальным
+    await asyncio.gather(
+        *(bot.send_message(admin_id, text, reply_markup=kb) for admin_id in admin_ids),
+        return_exceptions=True,
+    )
 
 
 # ---------------- Subscription watcher ----------------
 
+WARN_TEXT = (
+    "⏳ До окончания подписки осталось меньше 2 дней.\n"
+    "Пожалуйста, оплатите подписку, чтобы доступ не прервался.\n\n"
+    "Нажмите «Оплатить» в личном кабинете."
+)
+EXPIRED_TEXT = (
+    "⚠️ Подписка окончена.\n"
+    "Оплатите в течение 2 дней, иначе ключ будет удалён.\n\n"
+    "Нажмите «Оплатить» в личном кабинете."
+)
+KEYS_DELETED_TEXT = (
+    "❌ Ключи удалены, так как подписка не была оплачена в течение 2 дней после окончания.\n"
+    "Оплатите подписку, и администратор выдаст новый ключ."
+)
+
+
+# Telegram режет рассылку примерно на 30 сообщений/с: слот держим не меньше секунды,
+# так что одновременно и за секунду уходит не больше BROADCAST_PER_SECOND сообщений
+BROADCAST_PER_SECOND = 25
+_BROADCAST_SEM = asyncio.Semaphore(BROADCAST_PER_SECOND)
+
+
+async def _send_limited(bot: Bot, user_id: int, text: str) -> None:
+    async with _BROADCAST_SEM:
+        started = time.monotonic()
+        try:
+            await bot.send_message(user_id, text)
+        finally:
+            # и при ошибке доставки: неудачный запрос тоже идёт в лимит Telegram
+            await asyncio.sleep(max(0.0, 1 - (time.monotonic() - started)))
+
+
+async def _send_all(bot: Bot, user_ids: list[int], text: str) -> list[int]:
+    """
+    Рассылает text параллельно (с лимитом скорости), возвращает id тех, кому доставлено.
+    """
+    results = await asyncio.gather(
+        *(_send_limited(bot, uid, text) for uid in user_ids),
+        return_exceptions=True,
+    )
+    return [uid for uid, res in zip(user_ids, results) if not isinstance(res, BaseException)]
+
+
+async def _fetch_ids(db: aiosqlite.Connection, sql: str, params: dict) -> list[int]:
+    cur = await db.execute(sql, params)
+    return [row[0] for row in await cur.fetchall()]
+
+
 async def subscription_watcher(bot: Bot):
     while True:
         try:
-            now = datetime.now(timezone.utc)
-
-            async with aiosqlite.connect(DB_PATH) as db:
-                cur = await db.execute("""
-                    SELECT telegram_id, expires_at, warn_2d_sent, expired_sent, keys_deleted
-                    FROM subscriptions
-                    WHERE expires_at IS NOT NULL AND expires_at != ''
-                """)
-                subs = await cur.fetchall()
-
-                for telegram_id, expires_at, warn_2d_sent, expired_sent, keys_deleted in subs:
-                    exp_dt = _parse_iso(expires_at)
-                    if not exp_dt:
-                        continue
-
-                    warn_2d_sent = int(warn_2d_sent or 0)
-                    expired_sent = int(expired_sent or 0)
-                    keys_deleted = int(keys_deleted or 0)
-
-                    if exp_dt > now:
-                        remaining = exp_dt - now
-
-                        if expired_sent == 1 or keys_deleted == 1:
-                            await db.execute(
-                                "UPDATE subscriptions SET expired_sent=0, keys_deleted=0 WHERE telegram_id=?",
-                                (telegram_id,)
-                            )
-
-                        if remaining <= WARN_BEFORE and warn_2d_sent == 0:
-                            try:
-                                await bot.send_message(
-                                    telegram_id,
-                                    "⏳ До окончания подписки осталось меньше 2 дней.\n"
-                                    "Пожалуйста, оплатите подписку, чтобы доступ не прервался.\n\n"
-                                    "Нажмите «Оплатить» в личном кабинете."
-                                )
-                                await db.execute(
-                                    "UPDATE subscriptions SET warn_2d_sent=1 WHERE telegram_id=?",
-                                    (telegram_id,)
-                                )
-                            except Exception:
-                                pass
-
-                        if remaining > WARN_BEFORE and warn_2d_sent == 1:
-                            await db.execute(
-                                "UPDATE subscriptions SET warn_2d_sent=0 WHERE telegram_id=?",
-                                (telegram_id,)
-                            )
-
-                    else:
-                        if expired_sent == 0:
-                            try:
-                                await bot.send_message(
-                                    telegram_id,
-                                    "⚠️ Подписка окончена.\n"
-                                    "Оплатите в течение 2 дней, иначе ключ будет удалён.\n\n"
-                                    "Нажмите «Оплатить» в личном кабинете."
-                                )
-                                await db.execute(
-                                    "UPDATE subscriptions SET expired_sent=1 WHERE telegram_id=?",
-                                    (telegram_id,)
-                                )
-                            except Exception:
-                                pass
-
-                        if now >= exp_dt + GRACE_AFTER_EXPIRE and keys_deleted == 0:
-                            try:
-                                await db.execute(
-                                    "UPDATE user_keys SET outline_key=NULL, v2ray_key=NULL, amnezia_key=NULL, updated_at=?, updated_by=? WHERE user_id=?",
-                                    (now.isoformat(), 0, telegram_id)
-                                )
-                                await db.execute(
-                                    "UPDATE subscriptions SET keys_deleted=1 WHERE telegram_id=?",
-                                    (telegram_id,)
-                                )
-                                await db.commit()
-
-                                try:
-                                    await bot.send_message(
-                                        telegram_id,
-                                        "❌ Ключи удалены, так как подписка не была оплачена в течение 2 дней после окончания.\n"
-                                        "Оплатите подписку, и администратор выдаст новый ключ."
-                                    )
-                                except Exception:
-                                    pass
-                            except Exception:
-                                pass
-
-                await db.commit()
+            # время тика считаем один раз: и для выборок, и для updated_at
+            now_ts = int(time.time())
+            warn_at = now_ts + WARN_BEFORE_SECONDS
+            grace_at = now_ts - GRACE_AFTER_EXPIRE_SECONDS
+
+            # по запросу на каждый переход: SQL сразу отдаёт только id, по которым есть что делать,
+            # а диапазоны по expires_at идут по частичному индексу
+            params = {"now": now_ts, "warn": warn_at, "grace": grace_at}
+            async with database.connection() as db:
+                to_warn = await _fetch_ids(db, """
+                    SELECT telegram_id FROM subscriptions
+                    WHERE expires_at > :now AND expires_at <= :warn AND warn_2d_sent=0
+                """, params)
+                warn_clear = await _fetch_ids(db, """
+                    SELECT telegram_id FROM subscriptions
+                    WHERE expires_at > :warn AND warn_2d_sent=1
+                """, params)
+                expired_clear = await _fetch_ids(db, """
+                    SELECT telegram_id FROM subscriptions
+                    WHERE expires_at > :now AND (expired_sent=1 OR keys_deleted=1)
+                """, params)
+                to_expire = await _fetch_ids(db, """
+                    SELECT telegram_id FROM subscriptions
+                    WHERE expires_at <= :now AND expired_sent=0
+                """, params)
+                keys_delete = await _fetch_ids(db, """
+                    SELECT telegram_id FROM subscriptions
+                    WHERE expires_at <= :grace AND keys_deleted=0
+                """, params)
+
+            # флаг уведомления ставим только тем, кому сообщение реально ушло
+            warned, expired = await asyncio.gather(
+                _send_all(bot, to_warn, WARN_TEXT),
+                _send_all(bot, to_expire, EXPIRED_TEXT),
+            )
+
+            # рассылка могла занять секунды: за это время админ мог продлить подписку,
+            # поэтому каждое UPDATE заново проверяет условие по expires_at
+            keys_deleted = []
+            if expired_clear or warn_clear or keys_delete or warned or expired:
+                async with database.transaction() as db:
+                    await db.executemany("""
+                        UPDATE subscriptions SET expired_sent=0, keys_deleted=0
+                        WHERE telegram_id=:uid AND expires_at > :now
+                    """, [{"uid": uid, **params} for uid in expired_clear])
+                    await db.executemany("""
+                        UPDATE subscriptions SET warn_2d_sent=0
+                        WHERE telegram_id=:uid AND expires_at > :warn
+                    """, [{"uid": uid, **params} for uid in warn_clear])
+                    await db.executemany("""
+                        UPDATE subscriptions SET warn_2d_sent=1
+                        WHERE telegram_id=:uid AND expires_at > :now AND expires_at <= :warn
+                    """, [{"uid": uid, **params} for uid in warned])
+                    await db.executemany("""
+                        UPDATE subscriptions SET expired_sent=1
+                        WHERE telegram_id=:uid AND expires_at <= :now
+                    """, [{"uid": uid, **params} for uid in expired])
+
+                    # ключи стираем только тем, у кого флаг реально переключился здесь же
+                    for uid in keys_delete:
+                        cur = await db.execute("""
+                            UPDATE subscriptions SET keys_deleted=1
+                            WHERE telegram_id=:uid AND expires_at <= :grace AND keys_deleted=0
+                        """, {"uid": uid, **params})
+                        if cur.rowcount != 1:
+                            continue
+                        await db.execute(
+                            "UPDATE user_keys SET outline_key=NULL, v2ray_key=NULL, amnezia_key=NULL, updated_at=?, updated_by=0 WHERE user_id=?",
+                            (now_ts, uid)
+                        )
+                        keys_deleted.append(uid)
+
+            if keys_deleted:
+                await _send_all(bot, keys_deleted, KEYS_DELETED_TEXT)
 
         except Exception:
             pass
 
-        await asyncio.sleep(CHECK_INTERVAL_SECONDS)
+        # ждём следующий тик или сигнал, что подписки изменились
+        try:
+            await asyncio.wait_for(database.WAKE_EVENT.wait(), timeout=CHECK_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        database.WAKE_EVENT.clear()
 
 
 # ---------------- Cabinet sender ----------------
@@ -404,19 +513,16 @@ async def send_cabinet(bot: Bot, chat_id: int, user_obj):
         username=user_obj.username,
     )
 
-    user, sub = await get_user_and_sub(user_obj.id)
+    # upsert должен закоммититься до чтения: для нового пользователя иначе читать нечего
+    user, sub, (outline_key, v2ray_key, amnezia_key), refs_count = await get_cabinet(user_obj.id)
     if not user:
         await bot.send_message(chat_id, "Нажмите /start ещё раз")
         return
 
-    outline_key, v2ray_key, amnezia_key = await get_keys(user_obj.id)
-    refs_count = await referrals.get_referrals_count(user_obj.id)
-
     await bot.send_message(
         chat_id,
         cabinet_text(user, sub, refs_count, outline_key, v2ray_key, amnezia_key),
-        reply_markup=cabinet_actions_kb(outline_key, v2ray_key, amnezia_key),
-        parse_mode=ParseMode.HTML
+        reply_markup=cabinet_actions_kb(outline_key, v2ray_key, amnezia_key)
     )
 
 
@@ -427,8 +533,10 @@ async def main():
     if not token:
         raise RuntimeError("Нет BOT_TOKEN в .env")
 
+    # список админов после старта не меняется
     admin_ids = parse_admin_ids(os.getenv("ADMIN_IDS"))
 
+    await database.connect(DB_PATH)
     await init_db()
 
     bot = Bot(
@@ -441,25 +549,24 @@ async def main():
     me = await bot.get_me()
     bot_username = me.username
 
-    admin.setup_admin(DB_PATH, admin_ids)
+    admin.setup_admin(admin_ids)
     dp.include_router(admin.router)
 
-    referrals.setup_referrals(DB_PATH, bot_username)
+    referrals.setup_referrals(bot_username)
     dp.include_router(referrals.router)
 
-    pay.setup_pay(DB_PATH, admin_ids)
+    pay.setup_pay(admin_ids)
     await pay.init_pay_db()
     dp.include_router(pay.router)
 
     dp.include_router(tariffs.router)
 
     asyncio.create_task(subscription_watcher(bot))
+    pay.start_payments_writer()
 
     @dp.message(CommandStart())
     async def start(message: Message):
-        is_new = not await user_exists(message.from_user.id)
-
-        await upsert_user(
+        is_new = await upsert_user(
             telegram_id=message.from_user.id,
             first_name=message.from_user.first_name or "",
             last_name=message.from_user.last_name or "",
@@ -470,10 +577,10 @@ async def main():
         if is_new:
             referrer_id = await referrals.apply_referral_on_start(message.from_user.id, message.text)
             if referrer_id:
-                full_name = " ".join([p for p in [message.from_user.first_name, message.from_user.last_name] if p]).strip() or "Без имени"
+                full_name = utils.full_name(message.from_user.first_name, message.from_user.last_name)
                 mention = f'<a href="tg://user?id={message.from_user.id}">{full_name}</a>'
                 try:
-                    await bot.send_message(referrer_id, f"✅ Ваш реферал {mention} зарегистрировался в боте.", parse_mode=ParseMode.HTML)
+                    await bot.send_message(referrer_id, f"✅ Ваш реферал {mention} зарегистрировался в боте.")
                 except Exception:
                     pass
 
@@ -509,8 +616,7 @@ async def main():
         if outline_key:
             await callback.message.answer(
                 "🔑 <b>Ваш ключ OutLine</b>\n\n"
-                f"<code>{outline_key}</code>",
-                parse_mode=ParseMode.HTML
+                f"<code>{outline_key}</code>"
             )
         await callback.answer()
 
@@ -520,8 +626,7 @@ async def main():
         if v2ray_key:
             await callback.message.answer(
                 "🔑 <b>Ваш ключ v2raytun</b>\n\n"
-                f"<code>{v2ray_key}</code>",
-                parse_mode=ParseMode.HTML
+                f"<code>{v2ray_key}</code>"
             )
         await callback.answer()
 
@@ -531,12 +636,14 @@ async def main():
         if amnezia_key:
             await callback.message.answer(
                 "🔑 <b>Ваш ключ AmneziaVPN</b>\n\n"
-                f"<code>{amnezia_key}</code>",
-                parse_mode=ParseMode.HTML
+                f"<code>{amnezia_key}</code>"
             )
         await callback.answer()
 
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await database.close()
 
 
 if __name__ == "__main__":
@@ -1,24 +1,29 @@
-import aiosqlite
-from datetime import datetime, timezone
-from html import escape
-
-from aiogram import Router, F
+import asyncio
+import functools
+import re
+import time
+from html import escape, unescape
+from types import MappingProxyType
+
+from aiogram import Bot, Router, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import CallbackQuery, Message, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.enums import ParseMode
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 
+import database
+import utils
+
 router = Router()
 
-_DB_PATH: str | None = None
-_ADMIN_IDS: set[int] = set()
+_ADMIN_IDS: frozenset[int] = frozenset()
 
-# --- ТАРИФЫ ---
-TARIFFS = {
+# --- ТАРИФЫ --- (только чтение)
+TARIFFS = MappingProxyType({
     "outline": {"title": "OutLine", "price": 70},
     "v2ray": {"title": "v2raytun", "price": 70},
     "bundle": {"title": "OutLine/V2RayTun + AmneziaVPN", "price": 140},
-}
+})
 
 # сюда потом вставишь свои реквизиты
 PAY_REQUISITES_TEMPLATE = (
@@ -31,6 +36,22 @@ PAY_REQUISITES_TEMPLATE = (
     "Я передам его администратору на проверку."
 )
 
+# текст реквизитов по тарифу — форматируется один раз при импорте
+_TARIFF_TEXTS = MappingProxyType({
+    code: PAY_REQUISITES_TEMPLATE.format(tariff_title=t["title"], price=t["price"])
+    for code, t in TARIFFS.items()
+})
+
+# лимит подписи к фото в Telegram; длинный комментарий уходит отдельным сообщением
+CAPTION_MAX_LEN = 1024
+_HTML_TAG_RE = re.compile(r"<[^>]+>")
+
+
+def _caption_len(html_text: str) -> int:
+    # Telegram считает видимый текст (без тегов, с раскрытыми сущностями) в UTF-16 единицах:
+    # эмодзи вне BMP — это две единицы
+    return len(unescape(_HTML_TAG_RE.sub("", html_text)).encode("utf-16-le")) // 2
+
 
 class PayStates(StatesGroup):
     choosing_tariff = State()
@@ -38,68 +59,157 @@ class PayStates(StatesGroup):
     waiting_comment = State()
 
 
-def setup_pay(db_path: str, admin_ids: set[int]) -> None:
-    global _DB_PATH, _ADMIN_IDS
-    _DB_PATH = db_path
-    _ADMIN_IDS = admin_ids
+def setup_pay(admin_ids: set[int] | frozenset[int]) -> None:
+    global _ADMIN_IDS
+    _ADMIN_IDS = frozenset(admin_ids)
 
 
 async def init_pay_db():
-    if _DB_PATH is None:
-        raise RuntimeError("pay not setup: call setup_pay() first")
-
-    async with aiosqlite.connect(_DB_PATH) as db:
+    async with database.transaction() as db:
         await db.execute("""
             CREATE TABLE IF NOT EXISTS payments (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER NOT NULL,
-                created_at TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
                 screenshot_file_id TEXT NOT NULL,
                 tariff TEXT NOT NULL,
                 comment TEXT,
-                status TEXT NOT NULL DEFAULT 'pending'
+                status TEXT NOT NULL DEFAULT 'pending',
+                notified_at INTEGER
             )
         """)
-        # миграция (если таблица была раньше без tariff)
-        try:
-            await db.execute("ALTER TABLE payments ADD COLUMN tariff TEXT")
-        except Exception:
-            pass
-        try:
-            await db.execute("ALTER TABLE payments ADD COLUMN comment TEXT")
-        except Exception:
-            pass
+        # миграция (если таблица была раньше без tariff/comment/notified_at)
+        await database.add_missing_columns(
+            db, "payments", {"tariff": "TEXT", "comment": "TEXT", "notified_at": "INTEGER"}
+        )
+        # старые БД хранили created_at ISO-строкой — переводим в unix-секунды
+        await database.convert_column_to_epoch(db, "payments", "created_at")
+
+        # поиск последней pending-оплаты пользователя (admin.py) — одним seek по индексу
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_pay_user_status ON payments(user_id, status, id DESC)")
+
+        # один скриншот от пользователя — одна pending-оплата: повторная отправка не плодит
+        # заявки, а админов дёргает, только если прежняя до них не дошла (notified_at).
+        # Индекс частичный — обработанные оплаты он не трогает
+        cur = await db.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='ux_payment_pending'")
+        if await cur.fetchone() is None:
+            # старые pending-дубли мешают индексу: ничего не удаляем, а помечаем все, кроме последнего
+            # (admin.py подтверждает именно последнюю pending-оплату)
+            await db.execute("""
+                UPDATE payments SET status='duplicate'
+                WHERE status='pending' AND id NOT IN (
+                    SELECT MAX(id) FROM payments WHERE status='pending'
+                    GROUP BY user_id, screenshot_file_id
+                )
+            """)
+            await db.execute("DROP INDEX IF EXISTS ux_payment_dup")
+            await db.execute(
+                "CREATE UNIQUE INDEX ux_payment_pending ON payments(user_id, screenshot_file_id) WHERE status='pending'"
+            )
+
 
-        await db.commit()
+# Запись оплат пачками: скриншоты, пришедшие пока шёл прошлый commit,
+# уходят одной транзакцией с одним commit. Очередь ограничена — при перегрузке
+# handler ждёт места, а не копит память.
+PAYMENTS_BATCH_MAX = 500
+# дубль pending-оплаты (тот же пользователь + тот же скриншот) игнорируется: RETURNING не вернёт строку
+_SQL_INSERT_PAYMENT = (
+    "INSERT OR IGNORE INTO payments(user_id, created_at, screenshot_file_id, tariff, comment, status) "
+    "VALUES (?, ?, ?, ?, ?, 'pending') RETURNING id"
+)
+# уже записанная pending-оплата дубля: дошла ли она до админов
+_SQL_PENDING_PAYMENT = (
+    "SELECT id, notified_at IS NOT NULL FROM payments "
+    "WHERE user_id=? AND screenshot_file_id=? AND status='pending'"
+)
+_PAYMENTS_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=1000)
+# сколько handler ждёт места в очереди: если writer встал, пользователь получит ошибку, а не тишину.
+# Поставленную в очередь оплату ждём без дедлайна — иначе commit мог бы пройти после ответа об ошибке
+PAYMENT_SAVE_TIMEOUT = 30.0
+_WRITER_TASK: asyncio.Task | None = None
+
+
+def start_payments_writer() -> asyncio.Task:
+    """Запускает payments_writer (из main.py) и держит ссылку на задачу."""
+    global _WRITER_TASK
+    if _WRITER_TASK is None or _WRITER_TASK.done():
+        _WRITER_TASK = asyncio.create_task(payments_writer())
+    return _WRITER_TASK
+
+
+async def payments_writer() -> None:
+    """
+    Фоновая задача (см. start_payments_writer): пишет оплаты из очереди в payments.
+    Каждый handler ждёт свой future и отвечает пользователю только после commit;
+    в future — (id оплаты, получили ли её уже админы): у повтора скриншота это id прежней записи.
+    """
+    while True:
+        batch = [await _PAYMENTS_QUEUE.get()]
+        while len(batch) < PAYMENTS_BATCH_MAX and not _PAYMENTS_QUEUE.empty():
+            batch.append(_PAYMENTS_QUEUE.get_nowait())
+
+        results = []
+        try:
+            # executemany не отдаёт RETURNING — построчно, но в одной транзакции
+            async with database.transaction() as db:
+                for row, _ in batch:
+                    async with db.execute(_SQL_INSERT_PAYMENT, row) as cur:
+                        new_row = await cur.fetchone()
+                    if new_row is not None:
+                        results.append((new_row[0], False))
+                        continue
+                    async with db.execute(_SQL_PENDING_PAYMENT, (row[0], row[2])) as cur:
+                        payment_id, notified = await cur.fetchone()
+                    results.append((payment_id, bool(notified)))
+        except Exception as e:
+            for _, saved in batch:
+                if not saved.done():
+                    saved.set_exception(e)
+        else:
+            for (_, saved), result in zip(batch, results):
+                if not saved.done():
+                    saved.set_result(result)
+
+
+_TARIFF_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="OutLine — 70 ₽/мес", callback_data="pay_tariff:outline")],
+    [InlineKeyboardButton(text="v2raytun — 70 ₽/мес", callback_data="pay_tariff:v2ray")],
+    [InlineKeyboardButton(text="OutLine/v2raytun + AmneziaVPN — 140 ₽/мес", callback_data="pay_tariff:bundle")],
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="pay_cancel")],
+])
+
+_CANCEL_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="pay_cancel")]
+])
+
+_REQUISITES_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Написать комментарий", callback_data="pay_comment")],
+    [InlineKeyboardButton(text="Отмена", callback_data="pay_cancel")],
+])
+
+_COMMENT_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Назад", callback_data="pay_comment_back")],
+    [InlineKeyboardButton(text="Отмена", callback_data="pay_cancel")],
+])
 
 
 def tariff_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="OutLine — 70 ₽/мес", callback_data="pay_tariff:outline")],
-        [InlineKeyboardButton(text="v2raytun — 70 ₽/мес", callback_data="pay_tariff:v2ray")],
-        [InlineKeyboardButton(text="OutLine/v2raytun + AmneziaVPN — 140 ₽/мес", callback_data="pay_tariff:bundle")],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="pay_cancel")],
-    ])
+    return _TARIFF_KB
 
 
 def cancel_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="pay_cancel")]
-    ])
+    return _CANCEL_KB
 
 
 def requisites_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Написать комментарий", callback_data="pay_comment")],
-        [InlineKeyboardButton(text="Отмена", callback_data="pay_cancel")],
-    ])
+    return _REQUISITES_KB
+
 
 def comment_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Назад", callback_data="pay_comment_back")],
-        [InlineKeyboardButton(text="Отмена", callback_data="pay_cancel")],
-    ])
+    return _COMMENT_KB
 
+
+@functools.lru_cache(maxsize=1024)
 def admin_manage_user_kb(user_id: int) -> InlineKeyboardMarkup:
     # должно совпасть с твоим admin.py (callback_data="admin_user:<id>")
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -107,14 +217,20 @@ def admin_manage_user_kb(user_id: int) -> InlineKeyboardMarkup:
     ])
 
 
-def _user_label(u) -> str:
-    full_name = " ".join([p for p in [u.first_name, u.last_name] if p]).strip() or "Пользователь"
-    username = f"@{u.username}" if u.username else "—"
-    user_id = u.id
+# aiogram User не хешируется — кэшируем по кортежу полей: повторные оплаты того же
+# пользователя берут готовую подпись (смена имени/username даёт новый ключ)
+@functools.lru_cache(maxsize=1024)
+def _user_label_cached(user_id: int, first: str | None, last: str | None, username: str | None) -> str:
+    full_name = utils.full_name(first, last, default="Пользователь")
+    username = f"@{username}" if username else "—"
     mention = f'<a href="tg://user?id={user_id}">{full_name}</a>'
     return f"{mention}\nUsername: <b>{username}</b>\nID: <code>{user_id}</code>"
 
 
+def _user_label(u) -> str:
+    return _user_label_cached(u.id, u.first_name, u.last_name, u.username)
+
+
 def _extract_image_file_id(message: Message) -> str | None:
     if message.photo:
         return message.photo[-1].file_id
@@ -124,6 +240,40 @@ def _extract_image_file_id(message: Message) -> str | None:
     return None
 
 
+# Фоновая рассылка админам: ссылки на задачи держим, чтобы их не собрал GC,
+# а семафор ограничивает число одновременных запросов к Bot API при всплеске оплат.
+_NOTIFY_TASKS: set[asyncio.Task] = set()
+_NOTIFY_SEM = asyncio.Semaphore(16)
+
+
+async def _notify_admins(
+    bot: Bot, payment_id: int, admin_text: str, file_id: str, kb: InlineKeyboardMarkup
+) -> None:
+    # file_id из сообщения пользователя уже принадлежит боту — Telegram не перезаливает файл,
+    # так что скриншот и текст уходят одним send_photo с подписью, если она влезает в лимит
+    fits_caption = _caption_len(admin_text) <= CAPTION_MAX_LEN
+
+    async def notify(admin_id: int) -> None:
+        # одному админу — по порядку, разным админам — параллельно
+        async with _NOTIFY_SEM:
+            if fits_caption:
+                try:
+                    await bot.send_photo(admin_id, photo=file_id, caption=admin_text, reply_markup=kb)
+                    return
+                except TelegramBadRequest:
+                    # подпись всё же не принята (лимит, разметка) — шлём текст и фото отдельно
+                    pass
+            await bot.send_message(admin_id, admin_text, reply_markup=kb)
+            await bot.send_photo(admin_id, photo=file_id, caption="🧾 Скриншот оплаты")
+
+    results = await asyncio.gather(*(notify(admin_id) for admin_id in _ADMIN_IDS), return_exceptions=True)
+    # отметка ставится, только если оплата дошла хотя бы до одного админа:
+    # иначе повторная отправка скриншота разошлёт её заново
+    if any(r is None for r in results):
+        async with database.transaction() as db:
+            await db.execute("UPDATE payments SET notified_at=? WHERE id=?", (int(time.time()), payment_id))
+
+
 @router.callback_query(F.data == "pay")
 async def pay_start(callback: CallbackQuery, state: FSMContext):
     await state.set_state(PayStates.choosing_tariff)
@@ -134,23 +284,36 @@ async def pay_start(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("pay_tariff:"))
-async def pay_choose_tariff(callback: CallbackQuery, state: FSMContext):
-    tariff_code = callback.data.split(":", 1)[1].strip()
-    if tariff_code not in TARIFFS:
-        await callback.answer("Неизвестный тариф", show_alert=True)
-        return
-
+async def _start_tariff(callback: CallbackQuery, state: FSMContext, tariff_code: str) -> None:
     await state.update_data(tariff=tariff_code, comment=None)
     await state.set_state(PayStates.waiting_screenshot)
 
-    t = TARIFFS[tariff_code]
-    text = PAY_REQUISITES_TEMPLATE.format(tariff_title=t["title"], price=t["price"])
-
-    await callback.message.answer(text, reply_markup=requisites_kb(), parse_mode=ParseMode.HTML)
+    await callback.message.answer(_TARIFF_TEXTS[tariff_code], reply_markup=requisites_kb())
     await callback.answer()
 
 
+# по handler'у на тариф: точное совпадение callback_data, без split и проверки кода на каждом событии
+@router.callback_query(F.data == "pay_tariff:outline")
+async def pay_tariff_outline(callback: CallbackQuery, state: FSMContext):
+    await _start_tariff(callback, state, "outline")
+
+
+@router.callback_query(F.data == "pay_tariff:v2ray")
+async def pay_tariff_v2ray(callback: CallbackQuery, state: FSMContext):
+    await _start_tariff(callback, state, "v2ray")
+
+
+@router.callback_query(F.data == "pay_tariff:bundle")
+async def pay_tariff_bundle(callback: CallbackQuery, state: FSMContext):
+    await _start_tariff(callback, state, "bundle")
+
+
+# старые клавиатуры в чатах могут прислать неизвестный тариф — отвечаем, чтобы не висел спиннер
+@router.callback_query(F.data.startswith("pay_tariff"))
+async def pay_tariff_unknown(callback: CallbackQuery):
+    await callback.answer("Неизвестный тариф", show_alert=True)
+
+
 @router.callback_query(F.data == "pay_comment")
 async def pay_comment_start(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
@@ -166,7 +329,7 @@ async def pay_comment_start(callback: CallbackQuery, state: FSMContext):
     else:
         text = "Напишите комментарий к оплате одним сообщением."
 
-    await callback.message.answer(text, reply_markup=comment_kb(), parse_mode=ParseMode.HTML)
+    await callback.message.answer(text, reply_markup=comment_kb())
     await callback.answer()
 
 
@@ -181,7 +344,7 @@ async def pay_comment_back(callback: CallbackQuery, state: FSMContext):
     else:
         text = "Ок, без комментария. Отправьте скриншот оплаты."
 
-    await callback.message.answer(text, reply_markup=requisites_kb(), parse_mode=ParseMode.HTML)
+    await callback.message.answer(text, reply_markup=requisites_kb())
     await callback.answer()
 
 
@@ -207,11 +370,6 @@ async def pay_waiting_comment(message: Message, state: FSMContext):
 
 @router.message(PayStates.waiting_screenshot)
 async def pay_waiting_screenshot(message: Message, state: FSMContext):
-    if _DB_PATH is None:
-        await message.answer("Ошибка конфигурации оплаты (DB_PATH).")
-        await state.clear()
-        return
-
     data = await state.get_data()
     tariff_code = data.get("tariff")
     comment = (data.get("comment") or "").strip() or None
@@ -225,22 +383,35 @@ async def pay_waiting_screenshot(message: Message, state: FSMContext):
         await message.answer(
             "Нужно отправить <b>фото/картинку</b> (скриншот).\n"
             "Если нужно, нажмите \"Написать комментарий\".",
-            reply_markup=requisites_kb(),
-            parse_mode=ParseMode.HTML
+            reply_markup=requisites_kb()
         )
         return
 
-    async with aiosqlite.connect(_DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO payments(user_id, created_at, screenshot_file_id, tariff, comment, status) VALUES (?, ?, ?, ?, ?, 'pending')",
-            (message.from_user.id, datetime.now(timezone.utc).isoformat(), file_id, tariff_code, comment)
+    saved = asyncio.get_running_loop().create_future()
+    try:
+        await asyncio.wait_for(_PAYMENTS_QUEUE.put((
+            (message.from_user.id, int(time.time()), file_id, tariff_code, comment),
+            saved,
+        )), PAYMENT_SAVE_TIMEOUT)
+        payment_id, notified = await saved
+    except Exception:
+        # в очередь не встали или транзакция откатилась — оплата не записана:
+        # состояние не сбрасываем, скриншот можно отправить ещё раз
+        await message.answer(
+            "⚠️ Не удалось сохранить оплату. Попробуйте отправить скриншот ещё раз чуть позже.",
+            reply_markup=requisites_kb()
         )
-        await db.commit()
+        return
 
-    await message.answer("✅ Скриншот получен. Передал администратору на проверку.")
     await state.clear()
 
-    # уведомляем админов + показываем тариф
+    if notified:
+        # этот скриншот уже на проверке и админы его получили — повторно не дёргаем;
+        # повтор, не дошедший до админов, рассылается ниже как новая оплата
+        await message.answer("Этот скриншот уже получен и передан администратору на проверку.")
+        return
+
+    # уведомляем админов + показываем тариф; текст собирается один раз — общий для всех админов
     t = TARIFFS[tariff_code]
     comment_block = ""
     if comment:
@@ -254,14 +425,11 @@ async def pay_waiting_screenshot(message: Message, state: FSMContext):
         "Ниже кнопка для управления подпиской этого пользователя."
     )
 
-    for admin_id in _ADMIN_IDS:
-        try:
-            await message.bot.send_message(
-                admin_id,
-                admin_text,
-                reply_markup=admin_manage_user_kb(message.from_user.id),
-                parse_mode=ParseMode.HTML
-            )
-            await message.bot.send_photo(admin_id, photo=file_id, caption="🧾 Скриншот оплаты")
-        except Exception:
-            pass
+    # оплата уже записана: рассылка админам уходит в фон, пользователь ждёт только commit
+    task = asyncio.create_task(
+        _notify_admins(message.bot, payment_id, admin_text, file_id, admin_manage_user_kb(message.from_user.id))
+    )
+    _NOTIFY_TASKS.add(task)
+    task.add_done_callback(_NOTIFY_TASKS.discard)
+
+    await message.answer("✅ Скриншот получен. Передал администратору на проверку.")
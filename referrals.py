@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from datetime import datetime, timedelta, timezone
+import time
 from typing import Optional, List, Tuple
 
 import aiosqlite
@@ -8,21 +8,43 @@ from aiogram import Router, F
 from aiogram.types import CallbackQuery
 from aiogram.enums import ParseMode
 
+import database
+import utils
+
 router = Router()
 
-_DB_PATH: str | None = None
 _BOT_USERNAME: str | None = None
 
 # Настройки рефералки
 BONUS_DAYS_FOR_REFERRER = 14      # рефереру после первой оплаты реферала
 TRIAL_DAYS_FOR_INVITEE = 3        # приглашённому сразу при заходе по ссылке
 
+# SQL горячих путей — модульные константы: один и тот же текст запроса на общем подключении
+# всегда попадает в кэш подготовленных выражений sqlite3 (cached_statements=128 с запасом)
+_SQL_UPSERT_SUB = """
+    INSERT INTO subscriptions(telegram_id, purchased_at, period_days, expires_at)
+    VALUES (:uid, :now, :days, :now + :days * :day)
+    ON CONFLICT(telegram_id) DO UPDATE SET
+        period_days = COALESCE(subscriptions.period_days, 0) + :days,
+        expires_at = MAX(COALESCE(subscriptions.expires_at, :now), :now) + :days * :day
+"""
+
+_SQL_UPDATE_REFERRER = "UPDATE users SET referrer_id=? WHERE telegram_id=? AND referrer_id IS NULL"
+
+_SQL_REFERRALS_SUMMARY = """
+    SELECT first_name, last_name, first_paid_at, COALESCE(ref_bonus_awarded, 0),
+           COUNT(*) OVER (),
+           (SELECT paid_referrals_count FROM users WHERE telegram_id = :rid)
+    FROM users
+    WHERE referrer_id = :rid
+    ORDER BY created_at DESC
+"""
+
 
 # ---------- setup / schema ----------
 
-def setup_referrals(db_path: str, bot_username: str) -> None:
-    global _DB_PATH, _BOT_USERNAME
-    _DB_PATH = db_path
+def setup_referrals(bot_username: str) -> None:
+    global _BOT_USERNAME
     _BOT_USERNAME = bot_username
 
 
@@ -31,29 +53,38 @@ async def ensure_referrals_schema(db: aiosqlite.Connection) -> None:
     Миграции для таблицы users.
     Вызывать из init_db() в main.py.
     """
-    # кто пригласил
-    try:
-        await db.execute("ALTER TABLE users ADD COLUMN referrer_id INTEGER")
-    except Exception:
-        pass
-
-    # за этого пользователя бонус рефереру уже выдавали (1/0)
-    try:
-        await db.execute("ALTER TABLE users ADD COLUMN ref_bonus_awarded INTEGER DEFAULT 0")
-    except Exception:
-        pass
-
-    # был ли у пользователя первый платный период (1/0)
-    try:
-        await db.execute("ALTER TABLE users ADD COLUMN first_paid INTEGER DEFAULT 0")
-    except Exception:
-        pass
+    added = await database.add_missing_columns(db, "users", {
+        # кто пригласил
+        "referrer_id": "INTEGER",
+        # за этого пользователя бонус рефереру уже выдавали (1/0)
+        "ref_bonus_awarded": "INTEGER DEFAULT 0",
+        # был ли у пользователя первый платный период (1/0)
+        "first_paid": "INTEGER DEFAULT 0",
+        # дата первой оплаты (когда админ впервые начислил месяцы)
+        "first_paid_at": "INTEGER",
+        # сколько рефералов этого пользователя уже оплатили (ведёт триггер ниже)
+        "paid_referrals_count": "INTEGER DEFAULT 0",
+    })
+
+    if "paid_referrals_count" in added:
+        # колонка новая — один раз досчитываем по уже выданным бонусам
+        await db.execute("""
+            UPDATE users SET paid_referrals_count = (
+                SELECT COUNT(*) FROM users r
+                WHERE r.referrer_id = users.telegram_id AND r.ref_bonus_awarded = 1
+            )
+        """)
 
-    # дата первой оплаты (когда админ впервые начислил месяцы)
-    try:
-        await db.execute("ALTER TABLE users ADD COLUMN first_paid_at TEXT")
-    except Exception:
-        pass
+    # бонус за реферала выдан (0 -> 1) — счётчик реферера +1; refs не пересчитывает список
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_ref_bonus
+        AFTER UPDATE OF ref_bonus_awarded ON users
+        WHEN NEW.ref_bonus_awarded = 1 AND IFNULL(OLD.ref_bonus_awarded, 0) = 0
+        BEGIN
+            UPDATE users SET paid_referrals_count = IFNULL(paid_referrals_count, 0) + 1
+            WHERE telegram_id = NEW.referrer_id;
+        END
+    """)
 
 
 # ---------- helpers ----------
@@ -91,77 +122,17 @@ def build_referral_link(user_id: int) -> str:
     return f"https://t.me/{_BOT_USERNAME}?start=ref_{user_id}"
 
 
-def _parse_iso(dt_iso: str | None) -> datetime | None:
-    if not dt_iso:
-        return None
-    try:
-        return datetime.fromisoformat(dt_iso)
-    except Exception:
-        return None
-
-
-def _fmt(dt_iso: str | None) -> str:
-    if not dt_iso:
-        return "—"
-    dt = _parse_iso(dt_iso)
-    if not dt:
-        return dt_iso
-    return dt.strftime("%d.%m.%Y %H:%M")
-
-
-async def add_days_to_subscription(user_id: int, days: int) -> None:
+async def _extend_subscription(db: aiosqlite.Connection, user_id: int, days: int) -> None:
     """
-    Универсально добавляет days к подписке:
+    Универсально добавляет days к подписке внутри уже открытой транзакции:
     - если подписки нет -> создаёт
     - если активна -> продлевает от expires_at
     - если просрочена -> продлевает от now
     """
-    if _DB_PATH is None:
-        raise RuntimeError("Referrals not setup: call setup_referrals() first")
+    now = int(time.time())
 
-    now = datetime.now(timezone.utc)
-
-    async with aiosqlite.connect(_DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT purchased_at, period_days, expires_at FROM subscriptions WHERE telegram_id=?",
-            (user_id,),
-        )
-        row = await cur.fetchone()
-
-        if not row:
-            purchased_at = now
-            period_days = days
-            expires_at = now + timedelta(days=days)
-            await db.execute(
-                """
-                INSERT INTO subscriptions(telegram_id, purchased_at, period_days, expires_at)
-                VALUES (?, ?, ?, ?)
-                """,
-                (user_id, purchased_at.isoformat(), period_days, expires_at.isoformat()),
-            )
-            await db.commit()
-            return
-
-        purchased_at, period_days, expires_at = row
-        period_days = int(period_days or 0)
-
-        base = now
-        exp_dt = _parse_iso(expires_at)
-        if exp_dt and exp_dt > now:
-            base = exp_dt
-
-        new_expires = base + timedelta(days=days)
-        new_period = period_days + days
-
-        await db.execute(
-            """
-            UPDATE subscriptions
-            SET period_days=?, expires_at=?
-            WHERE telegram_id=?
-            """,
-            (new_period, new_expires.isoformat(), user_id),
-        )
-        await db.commit()
+    # одним UPSERT: база продления = MAX(expires_at, now), без SELECT и ветвления в Python
+    await db.execute(_SQL_UPSERT_SUB, {"uid": user_id, "now": now, "days": days, "day": utils.SECONDS_PER_DAY})
 
 
 # ---------- core logic ----------
@@ -178,70 +149,36 @@ async def apply_referral_on_start(new_user_id: int, start_text: str | None) -> i
 
     ВАЖНО: +14 дней рефереру здесь НЕ выдаём (это делается в admin.py при первой оплате).
     """
-    if _DB_PATH is None:
-        raise RuntimeError("Referrals not setup: call setup_referrals() first")
-
     referrer_id = parse_referrer_id_from_start(start_text, new_user_id)
     if referrer_id is None:
         return None
 
-    async with aiosqlite.connect(_DB_PATH) as db:
-        cur = await db.execute("SELECT referrer_id FROM users WHERE telegram_id=?", (new_user_id,))
-        row = await cur.fetchone()
-        if not row:
+    # UPDATE сам проверяет, что реферер ещё не установлен: rowcount == 0 — привязки не было
+    # (пользователя нет или реферер уже есть); trial выдаём в той же транзакции
+    async with database.transaction() as db:
+        cur = await db.execute(_SQL_UPDATE_REFERRER, (referrer_id, new_user_id))
+        if cur.rowcount == 0:
             return None
 
-        current_referrer = row[0]
-        if current_referrer is not None:
-            return None
-
-        await db.execute(
-            "UPDATE users SET referrer_id=? WHERE telegram_id=? AND referrer_id IS NULL",
-            (referrer_id, new_user_id),
-        )
-        await db.commit()
-
-    # выдаём trial приглашённому
-    await add_days_to_subscription(new_user_id, TRIAL_DAYS_FOR_INVITEE)
+        await _extend_subscription(db, new_user_id, TRIAL_DAYS_FOR_INVITEE)
+    database.WAKE_EVENT.set()
 
     return referrer_id
 
 
-async def get_referrals_count(referrer_id: int) -> int:
-    if _DB_PATH is None:
-        raise RuntimeError("Referrals not setup: call setup_referrals() first")
-
-    async with aiosqlite.connect(_DB_PATH) as db:
-        cur = await db.execute("SELECT COUNT(*) FROM users WHERE referrer_id=?", (referrer_id,))
-        row = await cur.fetchone()
-    return int(row[0]) if row else 0
-
-
-async def get_referrals_list(referrer_id: int) -> List[Tuple[str | None, str | None, str | None, int]]:
+async def get_referrals_summary(referrer_id: int) -> Tuple[int, int, List[Tuple[str | None, str | None, str | None, int]]]:
     """
-    Возвращает список:
-      (first_name, last_name, first_paid_at, ref_bonus_awarded)
+    Возвращает (всего, оплатили, список) одним запросом:
+    всего — оконный COUNT в том же SELECT, оплатили — готовый счётчик paid_referrals_count реферера.
     """
-    if _DB_PATH is None:
-        raise RuntimeError("Referrals not setup: call setup_referrals() first")
-
-    async with aiosqlite.connect(_DB_PATH) as db:
-        cur = await db.execute(
-            """
-            SELECT first_name, last_name, first_paid_at, ref_bonus_awarded
-            FROM users
-            WHERE referrer_id=?
-            ORDER BY created_at DESC
-            """,
-            (referrer_id,),
-        )
+    async with database.connection() as db:
+        cur = await db.execute(_SQL_REFERRALS_SUMMARY, {"rid": referrer_id})
         rows = await cur.fetchall()
 
-    # приведение ref_bonus_awarded к int
-    out: List[Tuple[str | None, str | None, str | None, int]] = []
-    for first_name, last_name, first_paid_at, ref_bonus_awarded in rows:
-        out.append((first_name, last_name, first_paid_at, int(ref_bonus_awarded or 0)))
-    return out
+    if not rows:
+        return 0, 0, []
+    total, paid = rows[0][4], rows[0][5]
+    return int(total), int(paid or 0), [r[:4] for r in rows]
 
 
 # ---------- handlers ----------
@@ -260,29 +197,36 @@ async def ref_link(callback: CallbackQuery):
     await callback.answer()
 
 
+# неизменные куски строки реферала — склеиваются конкатенацией без форматирования на строку
+_REF_ROW_PAID = "• ✅ <b>"
+_REF_ROW_PENDING = "• ⏳ <b>"
+_REF_ROW_MID = "</b> — первая оплата: <b>"
+
+
 @router.callback_query(F.data == "refs")
 async def refs(callback: CallbackQuery):
-    rows = await get_referrals_list(callback.from_user.id)
+    total, paid_refs, rows = await get_referrals_summary(callback.from_user.id)
 
-    if not rows:
+    if not total:
         await callback.message.answer("👥 У вас пока нет рефералов.")
         await callback.answer()
         return
 
-    paid_refs = sum(1 for r in rows if r[3] == 1)  # ref_bonus_awarded == 1
     total_bonus_days = paid_refs * BONUS_DAYS_FOR_REFERRER
 
-    lines = [
-        "👥 <b>Ваши рефералы</b>\n",
-        f"🏆 <b>Суммарный бонус:</b> <b>{total_bonus_days}</b> дней",
-        f"✅ <b>Оплатили первый раз:</b> <b>{paid_refs}</b>\n",
-        "<b>Список:</b>"
-    ]
-
-    for first_name, last_name, first_paid_at, ref_bonus_awarded in rows:
-        full_name = (f"{first_name or ''} {last_name or ''}").strip() or "Без имени"
-        mark = "✅" if ref_bonus_awarded == 1 else "⏳"
-        lines.append(f"• {mark} <b>{full_name}</b> — первая оплата: <b>{_fmt(first_paid_at)}</b>")
+    # размер известен заранее: 4 строки шапки + по строке на реферала
+    lines = [""] * (4 + len(rows))
+    lines[0] = "👥 <b>Ваши рефералы</b>\n"
+    lines[1] = f"🏆 <b>Суммарный бонус:</b> <b>{total_bonus_days}</b> дней"
+    lines[2] = f"✅ <b>Оплатили первый раз:</b> <b>{paid_refs}</b>\n"
+    lines[3] = "<b>Список:</b>"
+
+    for i, (first_name, last_name, first_paid_at, ref_bonus_awarded) in enumerate(rows, start=4):
+        full_name = utils.full_name(first_name, last_name)
+        lines[i] = (
+            (_REF_ROW_PAID if ref_bonus_awarded == 1 else _REF_ROW_PENDING)
+            + full_name + _REF_ROW_MID + utils.human_date(first_paid_at) + "</b>"
+        )
 
     await callback.message.answer("\n".join(lines), parse_mode=ParseMode.HTML)
     await callback.answer()
@@ -0,0 +1,20 @@
+import functools
+from datetime import datetime, timezone
+
+# длина суток в секундах — общая для всех запросов, продлевающих подписку
+SECONDS_PER_DAY = 86400
+
+
+def full_name(first: str | None, last: str | None, default: str = "Без имени") -> str:
+    """Имя и фамилия пользователя одной строкой; default — если обоих нет."""
+    # без временных списков и join: имя чаще всего одно или оба сразу
+    name = f"{first} {last}" if first and last else (first or last or "")
+    return name.strip() or default
+
+
+@functools.lru_cache(maxsize=4096)
+def human_date(value: int | None) -> str:
+    """Unix-секунды из БД как ДД.ММ.ГГГГ ЧЧ:ММ (UTC); "—", если даты нет."""
+    if value is None:
+        return "—"
+    return datetime.fromtimestamp(value, timezone.utc).strftime("%d.%m.%Y %H:%M")